@@ -5,8 +5,11 @@ import sys
 sys.path.append('.')
 
 from models import ExtractedImage
-from database import SessionLocal, engine, Base
+from database import SessionLocal, engine, Base, add_missing_columns
 from utils.pdf_utils import extract_images_from_pdf
+from feature_store import feature_store
+from tile_store import tile_store
+from catalog_ingest import index_ingested
 
 def process_all_pdfs():
     """Process all PDFs in the pdfs folder and extract images"""
@@ -40,6 +43,7 @@ def process_all_pdfs():
             business_reference = os.path.splitext(pdf_file)[0].upper()
             
             # Store each image in database
+            image_records = []
             for info in images_info:
                 image_record = ExtractedImage(
                     image_path=info["image_path"],
@@ -49,13 +53,16 @@ def process_all_pdfs():
                     image_type="logo",
                     business_name=business_name,
                     business_reference=business_reference,
-                    uploaded_at=datetime.utcnow()
+                    uploaded_at=datetime.utcnow(),
+                    **info["render"]
                 )
                 db.add(image_record)
+                image_records.append(image_record)
                 total_images += 1
                 print(f"  - Extracted image: {os.path.basename(info['image_path'])}")
             
             db.commit()
+            index_ingested(image_records, images_info)
             print(f"  ✓ Successfully processed {len(images_info)} image(s)")
             
         except Exception as e:
@@ -63,9 +70,12 @@ def process_all_pdfs():
             db.rollback()
     
     db.close()
+    feature_store.compact()
+    tile_store.compact()
     print(f"\nBatch processing complete! Total images extracted: {total_images}")
 
 if __name__ == "__main__":
     # Create database tables
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
     process_all_pdfs() 
\ No newline at end of file
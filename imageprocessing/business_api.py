@@ -14,13 +14,25 @@ try:
     from .auth import get_business_from_api_key
     from .models import Business, ExtractedImage, DEXContent
     from .database import SessionLocal
-    from .utils.pdf_utils import extract_images_from_pdf
+    from .utils.pdf_utils import extract_images_from_pdf, thumbnail_path, render_settings
+    from .feature_store import feature_store
+    from .query_cache import query_cache
+    from .response_cache import response_cache
+    from .popularity import popularity
+    from .tile_store import remove_tiles
+    from .catalog_ingest import index_ingested
 except ImportError:
     # Fallback for direct execution
     from auth import get_business_from_api_key
     from models import Business, ExtractedImage, DEXContent
     from database import SessionLocal
-    from utils.pdf_utils import extract_images_from_pdf
+    from utils.pdf_utils import extract_images_from_pdf, thumbnail_path, render_settings
+    from feature_store import feature_store
+    from query_cache import query_cache
+    from response_cache import response_cache
+    from popularity import popularity
+    from tile_store import remove_tiles
+    from catalog_ingest import index_ingested
 
 router = APIRouter(prefix="/api/v1/business", tags=["Business API"])
 
@@ -50,6 +62,9 @@ class ImageResponse(BaseModel):
     page_number: int
     tags: Optional[str]
     image_type: str
+    extraction_mode: Optional[str] = None
+    image_format: Optional[str] = None
+    render_dpi: Optional[float] = None
     dex_content: Optional[DEXContentResponse]
 
 class BusinessStatsResponse(BaseModel):
@@ -100,12 +115,29 @@ async def upload_business_pdf(
     file: UploadFile = File(...),
     tags: str = Form(""),
     image_type: str = Form("logo"),
+    dpi: Optional[float] = Form(None),
+    max_dimension: Optional[int] = Form(None),
+    alpha: Optional[bool] = Form(None),
+    image_format: str = Form("png"),
+    image_quality: Optional[int] = Form(None),
+    extraction_mode: str = Form("pages"),
     business: Business = Depends(get_business_from_api_key)
 ):
-    """Upload and process PDF for a business"""
+    """Upload and process PDF for a business
+
+    dpi or max_dimension (longest side in pixels), alpha (on by default, off for jpeg),
+    image_format (png, jpeg, webp) and image_quality (PNG compression level or JPEG/WebP
+    quality) set how pages are stored.
+    extraction_mode "embedded" indexes the images embedded in the PDF instead of its pages,
+    each with its page number and bounding box; "both" indexes pages and images.
+    """
     
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
+    try:
+        settings = render_settings(dpi, max_dimension, alpha, image_format, image_quality, extraction_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     try:
         # Save uploaded file
@@ -127,13 +159,15 @@ async def upload_business_pdf(
             output_dir = os.path.join("extracted_images", business.name.lower().replace(" ", "_"))
             os.makedirs(output_dir, exist_ok=True)
             
-            extracted_images = extract_images_from_pdf(file_path, output_dir)
+            extracted_images = extract_images_from_pdf(file_path, output_dir, settings=settings)
             
             # Store extracted images in database
             db_images = SessionLocal()
             try:
+                new_images = []
                 for img_info in extracted_images:
                     new_image = ExtractedImage(
+                        business_id=business.id,
                         business_name=business.name,
                         business_reference=business.name.lower().replace(" ", "_"),
                         pdf_filename=file.filename,
@@ -141,11 +175,16 @@ async def upload_business_pdf(
                         page_number=img_info["page_number"],
                         tags=tags,
                         image_type=image_type,
-                        is_public=True
+                        is_public=True,
+                        **img_info["render"]
                     )
                     db_images.add(new_image)
+                    new_images.append(new_image)
                 
                 db_images.commit()
+                
+                # Make the new pages matchable under their new image ids
+                confusable = index_ingested(new_images, extracted_images)
             except Exception as db_error:
                 db_images.rollback()
                 raise HTTPException(status_code=500, detail=f"Database error: {str(db_error)}")
@@ -159,7 +198,8 @@ async def upload_business_pdf(
                 "message": f"Successfully processed PDF and extracted {len(extracted_images)} images",
                 "extracted_images": len(extracted_images),
                 "business_name": business.name,
-                "pdf_filename": file.filename
+                "pdf_filename": file.filename,
+                "confusable_pages": confusable
             }
             
         except Exception as e:
@@ -209,6 +249,9 @@ async def get_business_images(business: Business = Depends(get_business_from_api
             page_number=image.page_number,
             tags=image.tags,
             image_type=image.image_type,
+            extraction_mode=image.extraction_mode,
+            image_format=image.image_format,
+            render_dpi=image.render_dpi,
             dex_content=dex_response
         ))
     
@@ -237,15 +280,23 @@ async def delete_business_image(
     # Delete associated DEX content first
     db.query(DEXContent).filter(DEXContent.image_id == image_id).delete()
     
-    # Delete image file if it exists
-    if os.path.exists(image.image_path):
-        os.remove(image.image_path)
+    # Delete image file and its thumbnail if they exist
+    for path in (image.image_path, thumbnail_path(image.image_path)):
+        if os.path.exists(path):
+            os.remove(path)
     
     # Delete image record
     db.delete(image)
     db.commit()
     db.close()
     
+    # Drop its matching descriptors and cached scans so it can no longer be matched
+    feature_store.remove([image_id])
+    remove_tiles([image_id])
+    query_cache.invalidate_image(image_id)
+    response_cache.discard([image_id])
+    popularity.discard([image_id])
+    
     return {"message": "Image and associated DEX content deleted successfully"}
 
 # ===== DEX CONTENT MANAGEMENT =====
@@ -292,6 +343,8 @@ async def create_dex_content(
     db.commit()
     db.refresh(dex_content)
     db.close()
+    query_cache.invalidate_image(image_id)
+    response_cache.refresh([image_id])
     
     return {
         "message": "DEX content created successfully",
@@ -337,6 +390,8 @@ async def update_dex_content(
     
     db.commit()
     db.close()
+    query_cache.invalidate_image(image_id)
+    response_cache.refresh([image_id])
     
     return {
         "message": "DEX content updated successfully",
@@ -372,6 +427,8 @@ async def delete_dex_content(
     db.delete(dex_content)
     db.commit()
     db.close()
+    query_cache.invalidate_image(image_id)
+    response_cache.refresh([image_id])
     
     return {"message": "DEX content deleted successfully"}
 
@@ -404,6 +461,8 @@ async def toggle_dex_content(
     dex_content.is_active = not dex_content.is_active
     db.commit()
     db.close()
+    query_cache.invalidate_image(image_id)
+    response_cache.refresh([image_id])
     
     return {
         "message": f"DEX content {'activated' if dex_content.is_active else 'deactivated'}",
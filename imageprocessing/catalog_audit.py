@@ -0,0 +1,187 @@
+"""
+Near-duplicate and confusability audit of the match catalog
+Scores every pair of stored pages in blocks: the cascade bounds on the 16x16 thumbnails are
+a matrix product over a block pair, and only the pairs whose bound reaches the floor get the
+full score. Memory stays at a few block-sized matrices however large the catalog grows.
+
+The audit reports each page's nearest other page and clusters of pages that a scan could
+confuse (connected through pairs above the match threshold). New pages get the same check at
+ingest, against the pages already stored.
+"""
+
+import json
+import os
+import numpy as np
+
+try:
+    from feature_store import feature_store, FEATURE_DIR
+    from matcher import MATCH_THRESHOLD, DUPLICATE_THRESHOLD
+    from utils.similarity import score_matrix, histogram_matrix, upper_bound_matrix
+except ImportError:
+    from .feature_store import feature_store, FEATURE_DIR
+    from .matcher import MATCH_THRESHOLD, DUPLICATE_THRESHOLD
+    from .utils.similarity import score_matrix, histogram_matrix, upper_bound_matrix
+
+AUDIT_BLOCK = 256  # Pages per block; a block pair holds a few (256, 256) float32 matrices
+AUDIT_FLOOR = 0.5  # Pairs that cannot reach this are not scored; nearest scores below it read as 0
+CONFUSABLE_THRESHOLD = MATCH_THRESHOLD  # Two pages this similar can both match the same scan
+AUDIT_REPORT_PATH = os.path.join(FEATURE_DIR, "catalog_audit.json")
+
+_QUERY_FIELDS = ["gray", "hist", "grad", "stats", "thumb16"]
+
+
+def _as_queries(catalog: dict, rows: np.ndarray) -> list:
+    columns = {name: np.asarray(catalog[name][rows]) for name in _QUERY_FIELDS}
+    return [{name: columns[name][i] for name in _QUERY_FIELDS} for i in range(len(rows))]
+
+
+def _block_scores(queries: list, catalog: dict, rows: np.ndarray, floor: float, mask: np.ndarray = None):
+    """(Q, N) scores of queries against catalog rows; pairs whose bound is below floor read 0"""
+    hist = catalog["hist"][rows]
+    bound = upper_bound_matrix(queries, catalog["stats"][rows], catalog["thumb16"][rows], histogram_matrix(queries, hist))
+    keep = bound >= floor
+    if mask is not None:
+        keep &= mask
+    if not keep.any():
+        return np.zeros(keep.shape, dtype=np.float32)
+    return score_matrix(queries, catalog["gray"][rows], hist, catalog["grad"][rows], keep)
+
+
+def _clusters(count: int, pairs: list) -> list:
+    """Connected components (as lists of positions) of the pair graph, singletons left out"""
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j, _ in pairs:
+        parent[find(i)] = find(j)
+    groups = {}
+    for i in {position for pair in pairs for position in pair[:2]}:
+        groups.setdefault(find(i), []).append(i)
+    return [sorted(group) for group in groups.values()]
+
+
+def audit_catalog(store=feature_store, threshold: float = CONFUSABLE_THRESHOLD, floor: float = AUDIT_FLOOR,
+                  block: int = AUDIT_BLOCK) -> dict:
+    """Nearest other page of every stored page, confusable pairs and their clusters
+
+    Pairs are scored once (the score is symmetric), block by block over the upper triangle.
+    """
+    catalog = store.snapshot()
+    rows = np.flatnonzero(catalog["alive"])
+    ids = catalog["ids"][rows]
+    count = len(rows)
+    nearest_score = np.zeros(count, dtype=np.float32)
+    nearest = np.full(count, -1, dtype=np.int64)
+    pairs = []
+
+    for a in range(0, count, block):
+        queries = _as_queries(catalog, rows[a:a + block])
+        for b in range(a, count, block):
+            mask = None
+            if a == b:
+                mask = np.triu(np.ones((len(queries), min(block, count - b)), dtype=bool), k=1)
+            scores = _block_scores(queries, catalog, rows[b:b + block], floor, mask)
+
+            # Nearest other page, from both sides of each pair
+            best_col = scores.argmax(axis=1)
+            best = scores[np.arange(len(scores)), best_col]
+            better = best > nearest_score[a:a + len(scores)]
+            nearest_score[a:a + len(scores)][better] = best[better]
+            nearest[a:a + len(scores)][better] = b + best_col[better]
+
+            best_row = scores.argmax(axis=0)
+            best = scores[best_row, np.arange(scores.shape[1])]
+            better = best > nearest_score[b:b + scores.shape[1]]
+            nearest_score[b:b + scores.shape[1]][better] = best[better]
+            nearest[b:b + scores.shape[1]][better] = a + best_row[better]
+
+            for i, j in zip(*np.nonzero(scores >= threshold)):
+                pairs.append((a + int(i), b + int(j), float(scores[i, j])))
+
+    return {
+        "images": count,
+        "threshold": threshold,
+        "nearest": {
+            int(ids[i]): {
+                "image_id": int(ids[nearest[i]]) if nearest[i] >= 0 else None,
+                "similarity": float(nearest_score[i]),
+            }
+            for i in range(count)
+        },
+        "pairs": [
+            {"image_ids": [int(ids[i]), int(ids[j])], "similarity": score, "duplicate": score >= DUPLICATE_THRESHOLD}
+            for i, j, score in sorted(pairs, key=lambda pair: -pair[2])
+        ],
+        "clusters": sorted(
+            ([int(ids[i]) for i in group] for group in _clusters(count, pairs)),
+            key=len, reverse=True
+        ),
+    }
+
+
+def nearest_others(items, store=feature_store, threshold: float = CONFUSABLE_THRESHOLD) -> list:
+    """Ingest-time check of new pages against the stored catalog
+
+    items are (image, features) pairs of pages that may already be stored themselves; they
+    are never compared with their own row. Returns {"image_id", "nearest_image_id",
+    "similarity"} for every page whose nearest other page reaches the threshold.
+    """
+    items = list(items)
+    if not items:
+        return []
+    catalog = store.snapshot()
+    rows = np.flatnonzero(catalog["alive"])
+    queries = [features for _, features in items]
+    own_ids = np.array([image.id for image, _ in items], dtype=np.int64)
+    nearest_score = np.zeros(len(items), dtype=np.float32)
+    nearest = np.full(len(items), -1, dtype=np.int64)
+
+    for start in range(0, len(rows), AUDIT_BLOCK):
+        block_rows = rows[start:start + AUDIT_BLOCK]
+        mask = own_ids[:, None] != catalog["ids"][block_rows][None, :]
+        scores = _block_scores(queries, catalog, block_rows, threshold, mask)
+        best_col = scores.argmax(axis=1)
+        best = scores[np.arange(len(items)), best_col]
+        better = best > nearest_score
+        nearest_score[better] = best[better]
+        nearest[better] = catalog["ids"][block_rows][best_col[better]]
+
+    warnings = []
+    for (image, _), image_id, score in zip(items, nearest.tolist(), nearest_score.tolist()):
+        if image_id >= 0 and score >= threshold:
+            print(f"⚠️ New page {image.id} is confusable with image {image_id} (similarity {score:.3f})")
+            warnings.append({"image_id": image.id, "nearest_image_id": image_id, "similarity": score})
+    return warnings
+
+
+if __name__ == "__main__":
+    # Offline audit: print the confusable clusters and write the full report
+    import sys
+    sys.path.append('.')
+    from database import SessionLocal
+    from models import ExtractedImage
+
+    report = audit_catalog()
+    db = SessionLocal()
+    try:
+        paths = dict(db.query(ExtractedImage.id, ExtractedImage.image_path).all())
+    finally:
+        db.close()
+
+    print(f"Audited {report['images']} page(s): {len(report['pairs'])} confusable pair(s), "
+          f"{sum(pair['duplicate'] for pair in report['pairs'])} near-duplicate(s)")
+    for cluster in report["clusters"]:
+        print(f"Cluster of {len(cluster)}:")
+        for image_id in cluster:
+            nearest = report["nearest"][image_id]
+            print(f"  - {paths.get(image_id, image_id)}: nearest {nearest['image_id']} ({nearest['similarity']:.3f})")
+
+    os.makedirs(os.path.dirname(AUDIT_REPORT_PATH), exist_ok=True)
+    with open(AUDIT_REPORT_PATH, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {AUDIT_REPORT_PATH}")
@@ -0,0 +1,31 @@
+"""
+Post-ingest indexing of new catalog pages
+Every ingest path (/upload/, /upload-pdf/, the business upload and batch_processor) commits
+its ExtractedImage rows and then hands them here, so a new page becomes matchable the same
+way whichever path stored it.
+"""
+
+try:
+    from feature_store import feature_store
+    from tile_store import add_tiles
+    from response_cache import response_cache
+    from catalog_audit import nearest_others
+except ImportError:
+    from .feature_store import feature_store
+    from .tile_store import add_tiles
+    from .response_cache import response_cache
+    from .catalog_audit import nearest_others
+
+
+def index_ingested(images, images_info) -> list:
+    """Index committed pages with their extract_images_from_pdf info dicts, in the same order
+
+    Stores the matching descriptors and sub-page tiles under the new image ids and
+    precomputes their response payloads. Returns nearest_others() for the new pages: the
+    stored pages a scan could mistake them for, so the uploader can dedupe.
+    """
+    items = list(zip(images, images_info))
+    feature_store.add_many((image, info["features"]) for image, info in items)
+    add_tiles((image, info["tiles"]) for image, info in items)
+    response_cache.refresh(image.id for image, _ in items)
+    return nearest_others((image, info["features"]) for image, info in items)
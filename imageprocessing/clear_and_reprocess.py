@@ -5,6 +5,8 @@ sys.path.append('.')
 from imageprocessing.database import engine, Base
 from imageprocessing.models import ExtractedImage
 from imageprocessing.batch_processor import process_all_pdfs
+from imageprocessing.feature_store import feature_store
+from imageprocessing.tile_store import tile_store
 
 def clear_and_reprocess():
     """Clear database and re-process all PDFs with new filtering"""
@@ -12,6 +14,8 @@ def clear_and_reprocess():
     # Drop and recreate all tables
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    feature_store.clear()
+    tile_store.clear()
     
     print("Database cleared. Re-processing all PDFs with improved filtering...")
     
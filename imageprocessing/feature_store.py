@@ -0,0 +1,638 @@
+"""
+Persistent feature store for the match catalog
+Descriptors are computed once at ingest and kept on disk keyed by ExtractedImage.id,
+so matching never has to decode the stored PNGs again.
+
+On disk the catalog is a versioned binary snapshot plus a small append log:
+- features/catalog-<gen>.bin holds a header (format, feature-extractor version, generation,
+  count) followed by aligned column arrays. Every server worker and match process
+  memory-maps it read-only, so they all share one copy through the page cache.
+- features/catalog-<gen>.log holds fixed-size add/remove records for pages ingested or
+  deleted since that snapshot. Readers replay only the records they have not seen yet.
+- features/CURRENT names the live generation. Compaction folds the log into a new snapshot
+  and flips CURRENT; readers that see a newer number remap.
+"""
+
+import hashlib
+import os
+import struct
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from PIL import Image
+
+try:
+    from utils.image_features import (
+        extract_features, FEATURE_VERSION, FEATURE_SIZE, HIST_BINS, DESCRIPTOR_DIM, STATS_DIM
+    )
+except ImportError:
+    from .utils.image_features import (
+        extract_features, FEATURE_VERSION, FEATURE_SIZE, HIST_BINS, DESCRIPTOR_DIM, STATS_DIM
+    )
+
+FEATURE_DIR = "features/"
+TAG_HASHES = 2  # Bloom filter bits set per tag
+TAG_SLOTS = 16  # Exact tag codes stored per image
+
+SNAPSHOT_MAGIC = b"KLIPFEAT"
+LOG_MAGIC = b"KLIPFLOG"
+SNAPSHOT_FORMAT = 5
+HEADER = struct.Struct("<8sIIQQ")  # magic, format, feature version, generation, count
+HEADER_SIZE = 64
+ALIGN = 64
+
+# Column layout of a snapshot: name, dtype, per-image shape
+SNAPSHOT_FIELDS = [
+    ("ids", "<i8", ()),
+    ("business_id", "<i8", ()),  # Tenant of the image, 0 when it has none
+    ("business_reference", "<u8", ()),  # attribute_code() of the business reference
+    ("image_type", "<u8", ()),  # attribute_code() of the image type
+    ("tag_bits", "<u8", ()),  # tag_mask() of the tags, a 64-bit Bloom filter
+    ("tag_codes", "<u8", (TAG_SLOTS,)),  # tag_codes() of the tags: sorted attribute codes, 0-padded
+    ("tag_count", "<u2", ()),  # Number of distinct tags; above TAG_SLOTS only the Bloom filter has them all
+    ("is_public", "u1", ()),
+    ("phash", "<u8", ()),
+    ("hist", "<f4", (HIST_BINS,)),
+    ("stats", "<f4", (STATS_DIM,)),  # Cascade bounds: grayscale mean/variance, mean |gradient|
+    ("thumb8", "<f4", (8, 8)),
+    ("thumb16", "<f4", (16, 16)),
+    ("vector", "<f4", (DESCRIPTOR_DIM,)),
+    ("gray", "u1", (FEATURE_SIZE[1], FEATURE_SIZE[0])),
+    ("grad", "<f2", (2, FEATURE_SIZE[1], FEATURE_SIZE[0])),
+]
+ATTRIBUTE_FIELDS = ["business_id", "business_reference", "image_type", "tag_bits", "tag_codes", "tag_count", "is_public"]
+FEATURE_FIELDS = ["phash", "hist", "stats", "thumb8", "thumb16", "vector", "gray", "grad"]
+# Small columns every reader keeps as plain arrays; the large ones stay memory-mapped
+SMALL_FIELDS = ["ids"] + ATTRIBUTE_FIELDS + ["phash"]
+
+LOG_ADD = 1
+LOG_REMOVE = 2
+LOG_RECORD = np.dtype([("op", "<i8")] + [(name, dtype, shape) for name, dtype, shape in SNAPSHOT_FIELDS])
+
+COMPACT_LOG_RECORDS = 512  # Fold the log into a new snapshot once it holds this many records
+COMPACT_DEAD_FRACTION = 0.2  # ...or once this share of the rows are tombstones
+COMPACT_INLINE_FACTOR = 8  # Writers only compact inline if the background compactor falls this far behind
+COMPACT_INTERVAL = 60  # Seconds between background compaction checks
+
+
+def _layout(count: int):
+    """Byte offset of each column for a snapshot of count images"""
+    offsets = {}
+    offset = HEADER_SIZE
+    for name, dtype, shape in SNAPSHOT_FIELDS:
+        offsets[name] = offset
+        size = count * np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+        offset += -(-size // ALIGN) * ALIGN
+    return offsets, offset
+
+
+def _empty_arrays() -> dict:
+    return {name: np.zeros((0,) + shape, dtype=dtype) for name, dtype, shape in SNAPSHOT_FIELDS}
+
+
+def _write_header(f, magic: bytes, generation: int, count: int):
+    f.write(HEADER.pack(magic, SNAPSHOT_FORMAT, FEATURE_VERSION, generation, count).ljust(HEADER_SIZE, b"\0"))
+
+
+def _read_header(path: str, magic: bytes):
+    """Return (generation, count), or None if the file is from another format or extractor"""
+    with open(path, "rb") as f:
+        file_magic, file_format, feature_version, generation, count = HEADER.unpack(f.read(HEADER.size))
+    if file_magic != magic or file_format != SNAPSHOT_FORMAT or feature_version != FEATURE_VERSION:
+        return None
+    return generation, count
+
+
+def _replace_atomically(tmp_path: str, path: str):
+    with open(tmp_path, "rb+") as f:
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive cross-process lock on the file at path, created if needed
+
+    An OS file lock: a waiter waits for as long as the holder works, however long a
+    compaction takes, and the lock is released by the OS if the holder dies.
+    """
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK gives up after about 10 seconds; keep waiting
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_snapshot(path: str, generation: int, arrays: dict):
+    """Write a snapshot file atomically: a reader sees the whole file or none of it"""
+    count = len(arrays["ids"])
+    offsets, total = _layout(count)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        _write_header(f, SNAPSHOT_MAGIC, generation, count)
+        for name, dtype, shape in SNAPSHOT_FIELDS:
+            f.seek(offsets[name])
+            f.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+        f.truncate(total)
+    _replace_atomically(tmp_path, path)
+
+
+def map_snapshot(path: str) -> dict:
+    """Memory-map a snapshot read-only; returns None if it was written by another version"""
+    header = _read_header(path, SNAPSHOT_MAGIC)
+    if header is None:
+        return None
+    _, count = header
+    if count == 0:
+        return _empty_arrays()
+    offsets, _ = _layout(count)
+    return {
+        name: np.memmap(path, dtype=dtype, mode="r", offset=offsets[name], shape=(count,) + shape)
+        for name, dtype, shape in SNAPSHOT_FIELDS
+    }
+
+
+class SegmentedArray:
+    """Read-only concatenation of a memory-mapped snapshot column and the log's delta rows
+
+    Supports the access patterns of the matcher (len, slices, integer row arrays) without
+    copying the mapped base.
+    """
+
+    def __init__(self, base: np.ndarray, delta: np.ndarray):
+        self.base = base
+        self.delta = delta
+        self.split = len(base)
+        self.dtype = base.dtype
+        self.shape = (len(base) + len(delta),) + base.shape[1:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            parts = []
+            if start < self.split:
+                parts.append(self.base[start:min(stop, self.split)])
+            if stop > self.split:
+                parts.append(self.delta[max(start, self.split) - self.split:stop - self.split])
+            if not parts:
+                return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if np.isscalar(key):
+            key = int(key) % len(self)
+            return self.base[key] if key < self.split else self.delta[key - self.split]
+
+        rows = np.asarray(key)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        result = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        in_base = rows < self.split
+        result[in_base] = self.base[rows[in_base]]
+        result[~in_base] = self.delta[rows[~in_base] - self.split]
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+class FeatureStore:
+    """Stacked per-image descriptors backed by a memory-mapped snapshot and an append log"""
+
+    def __init__(self, directory: str = FEATURE_DIR):
+        self.directory = directory
+        self.current_path = os.path.join(directory, "CURRENT")
+        self.lock_path = os.path.join(directory, ".lock")
+        self._lock = threading.RLock()
+        self.generation = 0  # Snapshot generation currently mapped
+        self.stale = False  # The mapped generation was written by another extractor version
+        self._compactor = None
+        self._compactor_stop = threading.Event()
+        self._reset_state(_empty_arrays())
+
+    # ----- reading -----
+
+    def _reset_state(self, base: dict):
+        self._base = base
+        self._delta_parts = []
+        self._delta = _empty_arrays()
+        self._log_offset = HEADER_SIZE
+        self._log_records = 0
+        self._small = {name: np.asarray(base[name]) for name in SMALL_FIELDS}
+        self._alive = np.ones(len(base["ids"]), dtype=bool)
+        self._index = {int(image_id): row for row, image_id in enumerate(self._small["ids"].tolist())}
+        self._view = None
+
+    def _snapshot_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"catalog-{generation:010d}.bin")
+
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"catalog-{generation:010d}.log")
+
+    def _read_current(self) -> int:
+        try:
+            with open(self.current_path, "r") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _map(self, generation: int):
+        base = map_snapshot(self._snapshot_path(generation)) if generation else _empty_arrays()
+        self.stale = base is None
+        if self.stale:
+            print(f"⚠️ Feature snapshot {generation} is from another extractor version, ignoring it")
+            base = _empty_arrays()
+        self._reset_state(base)
+        self.generation = generation
+
+    def _read_log(self):
+        """Replay log records appended since the last read"""
+        if self.generation == 0 or self.stale:
+            return
+        path = self._log_path(self.generation)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        count = (size - self._log_offset) // LOG_RECORD.itemsize
+        if count <= 0:
+            return
+        with open(path, "rb") as f:
+            f.seek(self._log_offset)
+            records = np.frombuffer(f.read(count * LOG_RECORD.itemsize), dtype=LOG_RECORD)
+        self._log_offset += count * LOG_RECORD.itemsize
+        self._log_records += count
+        self._apply(records)
+
+    def _apply(self, records: np.ndarray):
+        """Apply add/remove records: adds become delta rows, superseded rows are tombstoned"""
+        dead_rows = []
+        added = []
+        next_row = len(self._alive)
+        for position, (op, image_id) in enumerate(zip(records["op"].tolist(), records["ids"].tolist())):
+            old_row = self._index.pop(image_id, None)
+            if old_row is not None:
+                dead_rows.append(old_row)
+            if op == LOG_ADD:
+                self._index[image_id] = next_row
+                added.append(position)
+                next_row += 1
+
+        self._alive = np.concatenate([self._alive, np.ones(len(added), dtype=bool)])
+        self._alive[dead_rows] = False
+
+        if added:
+            self._delta_parts.append(records[added])
+            delta = np.concatenate(self._delta_parts)
+            self._delta = {name: delta[name] for name, _, _ in SNAPSHOT_FIELDS}
+            for name in SMALL_FIELDS:
+                self._small[name] = np.concatenate([np.asarray(self._base[name]), self._delta[name]])
+        self._view = None
+
+    def _load(self):
+        """Remap if a new snapshot was published, then pick up new log records"""
+        for _ in range(3):
+            generation = self._read_current()
+            if generation == self.generation:
+                break
+            try:
+                self._map(generation)
+                break
+            except FileNotFoundError:
+                # Superseded and cleaned up between reading CURRENT and opening it; retry
+                continue
+        self._read_log()
+
+    # ----- writing -----
+
+    def _writer_lock(self):
+        """Cross-process lock so concurrent ingests in different workers don't lose updates"""
+        os.makedirs(self.directory, exist_ok=True)
+        return file_lock(self.lock_path)
+
+    def _publish(self, arrays: dict):
+        """Write the next snapshot with an empty log, point CURRENT at it and drop old files"""
+        generation = max(self._read_current(), self.generation) + 1
+        write_snapshot(self._snapshot_path(generation), generation, arrays)
+
+        log_tmp = self._log_path(generation) + ".tmp"
+        with open(log_tmp, "wb") as f:
+            _write_header(f, LOG_MAGIC, generation, 0)
+        _replace_atomically(log_tmp, self._log_path(generation))
+
+        current_tmp = self.current_path + ".tmp"
+        with open(current_tmp, "w") as f:
+            f.write(str(generation))
+        _replace_atomically(current_tmp, self.current_path)
+        self._map(generation)
+
+        # Keep the previous generation for readers that are just switching over
+        for name in os.listdir(self.directory):
+            if name.startswith("catalog-") and name.endswith((".bin", ".log")):
+                try:
+                    if int(name[8:18]) < generation - 1:
+                        os.remove(os.path.join(self.directory, name))
+                except (ValueError, OSError):
+                    # Still mapped elsewhere on Windows; a later publish retries
+                    pass
+
+    def _append(self, records: np.ndarray):
+        """Append records to the live log; compaction is left to the background compactor"""
+        if self.generation == 0 or self.stale:
+            # Nothing (valid) published yet: start a snapshot of the current extractor version
+            self._publish(self._live_arrays())
+        with open(self._log_path(self.generation), "ab") as f:
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._read_log()
+        if self._log_records >= COMPACT_LOG_RECORDS * COMPACT_INLINE_FACTOR:
+            self._publish(self._live_arrays())
+
+    def _live_arrays(self) -> dict:
+        """Materialize the live rows of snapshot + log as plain arrays"""
+        view = self._catalog_view()
+        rows = np.flatnonzero(view["alive"])
+        return {name: view[name][rows] for name, _, _ in SNAPSHOT_FIELDS}
+
+    def add_many(self, items, ids=None):
+        """Add or replace descriptors for a list of (image, features) pairs
+
+        image is the ExtractedImage row (anything with id and the catalog_attributes() columns).
+        ids, parallel to items, stores the rows under other keys than image.id.
+        """
+        items = list(items)
+        if not items:
+            return
+        ids = [image.id for image, _ in items] if ids is None else list(ids)
+        records = np.zeros(len(items), dtype=LOG_RECORD)
+        records["op"] = LOG_ADD
+        for record, key, (image, features) in zip(records, ids, items):
+            record["ids"] = key
+            for name, value in catalog_attributes(image).items():
+                record[name] = value
+            for name in FEATURE_FIELDS:
+                record[name] = features[name]
+        with self._lock, self._writer_lock():
+            self._load()
+            self._append(records)
+
+    def add(self, image, features: dict):
+        """Add or replace the descriptors of a single image"""
+        self.add_many([(image, features)])
+
+    def refresh_attributes(self, images, ids=None):
+        """Re-record the scope attributes of stored images whose columns changed, keeping their descriptors
+
+        ids, parallel to images, looks the rows up under other keys than image.id.
+        """
+        images = list(images)
+        ids = [image.id for image in images] if ids is None else list(ids)
+        with self._lock, self._writer_lock():
+            self._load()
+            view = self._catalog_view()
+            changed = []
+            for key, image in zip(ids, images):
+                row = self._index.get(int(key))
+                if row is None:
+                    continue
+                attributes = catalog_attributes(image)
+                if any(not np.array_equal(view[name][row], value) for name, value in attributes.items()):
+                    changed.append((row, attributes))
+            if not changed:
+                return
+            records = np.zeros(len(changed), dtype=LOG_RECORD)
+            records["op"] = LOG_ADD
+            for record, (row, attributes) in zip(records, changed):
+                for name, _, _ in SNAPSHOT_FIELDS:
+                    record[name] = view[name][row]
+                for name, value in attributes.items():
+                    record[name] = value
+            self._append(records)
+
+    def remove(self, image_ids):
+        """Tombstone the descriptors of deleted images"""
+        image_ids = [int(image_id) for image_id in image_ids]
+        with self._lock, self._writer_lock():
+            self._load()
+            image_ids = [image_id for image_id in image_ids if image_id in self._index]
+            if not image_ids:
+                return
+            records = np.zeros(len(image_ids), dtype=LOG_RECORD)
+            records["op"] = LOG_REMOVE
+            records["ids"] = image_ids
+            self._append(records)
+
+    def compact(self):
+        """Fold the append log into a fresh snapshot, dropping tombstoned rows"""
+        with self._lock, self._writer_lock():
+            self._load()
+            if self._log_records or self.stale or self.generation == 0:
+                self._publish(self._live_arrays())
+
+    def needs_compaction(self) -> bool:
+        """True once the log or the share of tombstoned rows has grown past its threshold"""
+        with self._lock:
+            self._load()
+            dead = len(self._alive) - int(self._alive.sum())
+            return (
+                self._log_records >= COMPACT_LOG_RECORDS
+                or (dead > 0 and dead >= COMPACT_DEAD_FRACTION * len(self._alive))
+            )
+
+    def start_compactor(self, interval: float = COMPACT_INTERVAL, reconcile=None):
+        """Compact in a daemon thread so ingest and delete requests only ever append
+
+        reconcile, if given, is called after every compaction to add the rows the store lacks.
+        """
+        if self._compactor is not None:
+            return
+        self._compactor_stop.clear()
+
+        def run():
+            while not self._compactor_stop.wait(interval):
+                try:
+                    if self.needs_compaction():
+                        self.compact()
+                        if reconcile is not None:
+                            reconcile()
+                except Exception as e:
+                    print(f"⚠️ Background feature compaction failed: {e}")
+
+        self._compactor = threading.Thread(target=run, name="feature-compactor", daemon=True)
+        self._compactor.start()
+
+    def stop_compactor(self):
+        if self._compactor is None:
+            return
+        self._compactor_stop.set()
+        self._compactor.join()
+        self._compactor = None
+
+    def clear(self):
+        """Drop every stored descriptor"""
+        with self._lock, self._writer_lock():
+            self._load()
+            self._publish(_empty_arrays())
+
+    # ----- queries -----
+
+    def _catalog_view(self) -> dict:
+        if self._view is None:
+            view = {}
+            for name, _, _ in SNAPSHOT_FIELDS:
+                if name in SMALL_FIELDS:
+                    view[name] = self._small[name]
+                elif len(self._delta[name]):
+                    view[name] = SegmentedArray(self._base[name], self._delta[name])
+                else:
+                    view[name] = self._base[name]
+            view["alive"] = self._alive
+            view["generation"] = (self.generation, self._log_records)
+            self._view = view
+        return self._view
+
+    def get(self, image_id: int) -> dict:
+        """Get the descriptors for one image, or None if it was never ingested"""
+        with self._lock:
+            self._load()
+            row = self._index.get(int(image_id))
+            if row is None:
+                return None
+            view = self._catalog_view()
+            return {name: view[name][row] for name in FEATURE_FIELDS}
+
+    def snapshot(self) -> dict:
+        """Current columns for the matcher, with the alive mask and a generation tag
+
+        Rows are stable until the next compaction; removed or replaced rows are only
+        marked dead in "alive".
+        """
+        with self._lock:
+            self._load()
+            return self._catalog_view()
+
+    def missing(self, image_ids):
+        """Return the ids that have no stored descriptors yet"""
+        with self._lock:
+            self._load()
+            return [image_id for image_id in image_ids if int(image_id) not in self._index]
+
+
+def _digest(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def attribute_code(value) -> int:
+    """Fixed-width code for a string attribute, 0 when it is empty"""
+    value = (value or "").strip().lower()
+    return _digest(value) if value else 0
+
+
+def split_tags(tags) -> set:
+    """Normalized tags of a comma-separated tag string"""
+    return {tag.strip().lower() for tag in (tags or "").split(",") if tag.strip()}
+
+
+def tag_mask(tags) -> int:
+    """64-bit Bloom filter of a tag string; a set of tags can only be present if all its bits are"""
+    mask = 0
+    for tag in split_tags(tags):
+        digest = _digest(tag)
+        for i in range(TAG_HASHES):
+            mask |= 1 << ((digest >> (6 * i)) & 63)
+    return mask
+
+
+def tag_codes(tags) -> np.ndarray:
+    """Sorted attribute codes of the first TAG_SLOTS tags of a tag string, padded with 0"""
+    codes = np.zeros(TAG_SLOTS, dtype=np.uint64)
+    values = sorted(attribute_code(tag) for tag in split_tags(tags))[:TAG_SLOTS]
+    codes[:len(values)] = values
+    return codes
+
+
+def catalog_attributes(image) -> dict:
+    """Per-image attributes stored next to the descriptors, used to scope matching"""
+    return {
+        "business_id": image.business_id or 0,
+        "business_reference": attribute_code(image.business_reference),
+        "image_type": attribute_code(image.image_type),
+        "tag_bits": tag_mask(image.tags),
+        "tag_codes": tag_codes(image.tags),
+        "tag_count": min(len(split_tags(image.tags)), 0xFFFF),
+        "is_public": bool(image.is_public),
+    }
+
+
+feature_store = FeatureStore()
+
+
+def backfill_features(db, store: FeatureStore = feature_store) -> int:
+    """Compute descriptors for catalog rows that have none, then compact"""
+    try:
+        from models import ExtractedImage
+    except ImportError:
+        from .models import ExtractedImage
+
+    rows = db.query(
+        ExtractedImage.id, ExtractedImage.image_path, ExtractedImage.business_id,
+        ExtractedImage.business_reference, ExtractedImage.image_type,
+        ExtractedImage.tags, ExtractedImage.is_public
+    ).all()
+    missing = set(store.missing([row.id for row in rows]))
+    store.refresh_attributes(row for row in rows if row.id not in missing)
+
+    items = []
+    for row in rows:
+        if row.id not in missing:
+            continue
+        if not os.path.exists(row.image_path):
+            print(f"⚠️ Cannot backfill features, file missing: {row.image_path}")
+            continue
+        try:
+            with Image.open(row.image_path) as img:
+                items.append((row, extract_features(img)))
+        except Exception as e:
+            print(f"⚠️ Cannot backfill features for {row.image_path}: {e}")
+
+    store.add_many(items)
+    store.compact()
+    return len(items)
+
+
+if __name__ == "__main__":
+    # Rebuild missing descriptors and compact the log, e.g. after bumping FEATURE_VERSION
+    import sys
+    sys.path.append('.')
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        print(f"Backfilled features for {backfill_features(db)} image(s)")
+    finally:
+        db.close()
@@ -2,13 +2,14 @@
 """
 Database initialization script
 """
-from database import engine, Base
+from database import engine, Base, add_missing_columns
 from models import User, UserUpload, UserActivity, Business, ExtractedImage, DEXContent
 
 def init_db():
     """Initialize the database with all tables"""
     print("Creating database tables...")
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
     print("Database tables created successfully!")
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+"""
+Live-scan sessions for the camera WebSocket
+The browser streams small JPEG frames. Frames that barely differ from the last scored one are
+skipped, later frames are first scored against the previous frame's shortlist instead of the
+whole catalog, and a match is only announced once the same image has won several frames
+in a row.
+"""
+
+import numpy as np
+
+try:
+    from match_executor import match_executor
+    from matcher import MATCH_THRESHOLD
+    from popularity import popularity
+    from utils.image_features import FrameQualityError
+except ImportError:
+    from .match_executor import match_executor
+    from .matcher import MATCH_THRESHOLD
+    from .popularity import popularity
+    from .utils.image_features import FrameQualityError
+
+MAX_LIVE_FRAME_BYTES = 2 * 1024 * 1024  # Live frames are downscaled by the client
+FRAME_DIFF_THRESHOLD = 3.0  # Mean absolute change of the 16x16 thumbnail, in gray levels
+STABLE_FRAMES = 3  # Consecutive frames the same image must win before it is announced
+SHORTLIST_SIZE = 16  # Best candidates of a full search carried over to the next frames
+
+
+class LiveScanSession:
+    """Per-connection state of one live scan"""
+
+    def __init__(self, scope: dict = None, nprobe: int = None):
+        self.scope = scope
+        self.nprobe = nprobe
+        self.last_thumb = None
+        self.last_result = None  # (image_id, similarity) of the last scored frame
+        self.shortlist = None
+        self.streak_id = None
+        self.streak = 0
+        self.announced_id = None
+
+    async def _score(self, features: dict, shortlist=None):
+        ids, similarities, _ = await match_executor.score_features(
+            features, nprobe=self.nprobe, scope=self.scope, shortlist=shortlist,
+            priority=popularity.top() if shortlist is None else None
+        )
+        order = np.argsort(-similarities, kind='stable')
+        return ids[order], similarities[order]
+
+    async def process(self, frame: bytes) -> dict:
+        """Handle one frame; returns the frame event, with "announce" set when a match just became stable"""
+        # Decoding, the quality check, the page crop and the descriptors all run in the match
+        # worker pool, like every other endpoint, so the event loop's process stays free
+        try:
+            features = await match_executor.extract_image(frame)
+        except FrameQualityError as e:
+            # An unusable frame leaves the streak as it was; the client can prompt the user
+            return {"type": "frame", "rejected": True, "reason": e.reason, "message": str(e), "announce": False}
+
+        thumb = features["thumb16"]
+        skipped = (
+            self.last_thumb is not None
+            and float(np.abs(thumb - self.last_thumb).mean()) < FRAME_DIFF_THRESHOLD
+        )
+        if not skipped:
+            self.last_thumb = thumb
+            ids = np.zeros(0, dtype=np.int64)
+            if self.shortlist is not None:
+                ids, similarities = await self._score(features, self.shortlist)
+            if len(ids) == 0 or similarities[0] < MATCH_THRESHOLD:
+                # Nothing on the shortlist holds up (or there is none yet): search the catalog
+                ids, similarities = await self._score(features)
+                self.shortlist = ids[:SHORTLIST_SIZE].tolist() if len(ids) else None
+            # A best candidate below the threshold is no candidate: it must not build a streak
+            matched = len(ids) > 0 and similarities[0] >= MATCH_THRESHOLD
+            self.last_result = (int(ids[0]), float(similarities[0])) if matched else None
+
+        # A skipped frame repeats the previous result, so a steady camera still settles
+        if self.last_result is None:
+            self.streak_id, self.streak, self.announced_id = None, 0, None
+        elif self.last_result[0] == self.streak_id:
+            self.streak += 1
+        else:
+            self.streak_id, self.streak = self.last_result[0], 1
+
+        stable = self.streak >= STABLE_FRAMES
+        announce = stable and self.streak_id != self.announced_id
+        if announce:
+            self.announced_id = self.streak_id
+        return {
+            "type": "frame",
+            "rejected": False,
+            "skipped": skipped,
+            "candidate_id": self.last_result[0] if self.last_result else None,
+            "similarity": self.last_result[1] if self.last_result else None,
+            "stable": stable,
+            "announce": announce,
+        }
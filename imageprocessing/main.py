@@ -1,10 +1,22 @@
-from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Request
+from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, Response
-from utils.pdf_utils import extract_images_from_pdf
+from utils.pdf_utils import extract_images_from_pdf, thumbnail_path, render_settings
+from utils.image_features import extract_features, MAX_QUERY_BYTES, FrameQualityError
+from utils.similarity import compare_features
+from utils.ivf_index import IVF_MAX_NPROBE
+from feature_store import feature_store, backfill_features, split_tags
+from tile_store import tile_store, backfill_tiles
+from catalog_ingest import index_ingested
+from matcher import MATCH_THRESHOLD, DUPLICATE_THRESHOLD, TIE_BREAK_NOISE, match_scope
+from match_executor import match_executor
+from live_scan import LiveScanSession, MAX_LIVE_FRAME_BYTES
+from query_cache import query_cache
+from popularity import popularity
+from response_cache import response_cache, match_response
 from models import ExtractedImage, Business, DEXContent
-from database import SessionLocal, engine, Base, get_db
+from database import SessionLocal, engine, Base, get_db, add_missing_columns
 from auth import get_db as auth_get_db
 from business_api import router as business_api_router
 from auth_api import router as auth_api_router
@@ -14,11 +26,17 @@ import glob
 from PIL import Image
 import io
 import numpy as np
-from typing import Optional
+from typing import List, Optional
+import zipfile
 import json
+import time
 
 UPLOAD_DIR = "pdfs/"
 IMAGE_DIR = "extracted_images/"
+MAX_BATCH_IMAGES = 500  # Scans accepted by one /match-image/batch request
+MAX_BATCH_ARCHIVE_BYTES = 512 * 1024 * 1024
+MAX_BATCH_TOTAL_BYTES = 1024 * 1024 * 1024  # Uploaded scans plus inflated archive entries, checked before reading
+BATCH_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
 
 app = FastAPI(title="PDF Image Extraction API", description="API for extracting images from PDFs")
 
@@ -35,8 +53,37 @@ app.add_middleware(
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
-# Create database tables
+# Create database tables, and add columns that older databases lack
 Base.metadata.create_all(bind=engine)
+add_missing_columns()
+
+def reconcile_features():
+    """Compute descriptors for catalog rows the feature store lacks, whatever its version"""
+    db = SessionLocal()
+    try:
+        backfilled = backfill_features(db)
+        if backfilled:
+            print(f"✅ Backfilled matching features for {backfilled} image(s)")
+    finally:
+        db.close()
+
+def reconcile_tiles():
+    """Same for the sub-page tiles, which also covers pages ingested before tiles existed"""
+    db = SessionLocal()
+    try:
+        tiled = backfill_tiles(db)
+        if tiled:
+            print(f"✅ Indexed sub-page tiles for {tiled} image(s)")
+    finally:
+        db.close()
+
+# Map the matching feature snapshots and add whatever rows they miss, e.g. pages ingested by
+# a path that failed before storing its descriptors; the compactors repeat this check
+reconcile_features()
+reconcile_tiles()
+
+# Precompute the match response payload of every image
+print(f"✅ Precomputed match responses for {response_cache.warm()} image(s)")
 
 # Mount static files for images
 app.mount("/images", StaticFiles(directory=IMAGE_DIR), name="images")
@@ -48,232 +95,360 @@ app.mount("/static", StaticFiles(directory="web_app"), name="static")
 app.include_router(business_api_router)
 app.include_router(auth_api_router)
 
+@app.on_event("startup")
+def start_feature_compactor():
+    """Fold the feature logs and drop tombstoned rows in the background"""
+    feature_store.start_compactor(reconcile=reconcile_features)
+    tile_store.start_compactor(reconcile=reconcile_tiles)
+
+@app.on_event("shutdown")
+def shutdown_match_executor():
+    """Stop the matching worker processes and the compactor, and save the popularity counts"""
+    match_executor.shutdown()
+    feature_store.stop_compactor()
+    tile_store.stop_compactor()
+    popularity.save()
+
 def calculate_image_similarity(img1: Image.Image, img2: Image.Image) -> float:
     """Calculate similarity between two images using improved comparison"""
     try:
-        # Resize images to same size for comparison
-        size = (64, 64)  # Smaller size for faster processing
-        img1_resized = img1.resize(size)
-        img2_resized = img2.resize(size)
-        
-        # Convert to grayscale and numpy arrays
-        img1_array = np.array(img1_resized.convert('L'))
-        img2_array = np.array(img2_resized.convert('L'))
-        
-        # Calculate multiple similarity metrics
-        
-        # 1. Mean Squared Error (MSE)
-        mse = np.mean((img1_array - img2_array) ** 2)
-        max_mse = 255 ** 2
-        mse_similarity = 1 - (mse / max_mse)
-        
-        # 2. Structural Similarity Index (SSIM-like)
-        # Calculate local means
-        kernel_size = 8
-        img1_mean = np.mean(img1_array)
-        img2_mean = np.mean(img2_array)
-        
-        # Calculate local variances
-        img1_var = np.var(img1_array)
-        img2_var = np.var(img2_array)
-        
-        # Calculate cross-correlation
-        img1_centered = img1_array - img1_mean
-        img2_centered = img2_array - img2_mean
-        cross_corr = np.mean(img1_centered * img2_centered)
-        
-        # SSIM-like score
-        if img1_var + img2_var == 0:
-            ssim_similarity = 1.0 if np.allclose(img1_array, img2_array) else 0.0
-        else:
-            ssim_similarity = (2 * cross_corr + 0.01) / (img1_var + img2_var + 0.01)
-            ssim_similarity = max(0, min(1, ssim_similarity))  # Clamp to [0,1]
-        
-        # 3. Histogram comparison
-        hist1, _ = np.histogram(img1_array, bins=32, range=(0, 256))
-        hist2, _ = np.histogram(img2_array, bins=32, range=(0, 256))
-        
-        # Normalize histograms
-        hist1 = hist1 / np.sum(hist1)
-        hist2 = hist2 / np.sum(hist2)
-        
-        # Calculate histogram intersection
-        hist_similarity = np.sum(np.minimum(hist1, hist2))
-        
-        # 4. Edge detection comparison (fallback if scipy not available)
-        try:
-            from scipy import ndimage
-            # Apply Sobel edge detection
-            img1_edges = ndimage.sobel(img1_array)
-            img2_edges = ndimage.sobel(img2_array)
-            
-            # Compare edge patterns
-            edge_diff = np.mean(np.abs(img1_edges - img2_edges))
-            edge_similarity = 1 - (edge_diff / 255)
-            edge_similarity = max(0, edge_similarity)
-        except ImportError:
-            # Fallback: simple gradient comparison
-            img1_grad = np.gradient(img1_array)
-            img2_grad = np.gradient(img2_array)
-            
-            grad_diff = np.mean(np.abs(img1_grad[0] - img2_grad[0])) + np.mean(np.abs(img1_grad[1] - img2_grad[1]))
-            edge_similarity = 1 - (grad_diff / 510)
-            edge_similarity = max(0, edge_similarity)
-        
-        # Combine all metrics with weights
-        final_similarity = (
-            0.3 * mse_similarity +
-            0.3 * ssim_similarity +
-            0.2 * hist_similarity +
-            0.2 * edge_similarity
-        )
-        
-        return max(0, min(1, final_similarity))
-        
+        return compare_features(extract_features(img1), extract_features(img2))
     except Exception as e:
         print(f"Error calculating similarity: {e}")
         return 0.0
 
 @app.post("/match-image/")
-async def match_image(image: UploadFile = File(...)):
-    """Match uploaded image against stored images"""
+async def match_image(
+    image: UploadFile = File(...),
+    nprobe: Optional[int] = Form(None),
+    business_reference: Optional[str] = Form(None),
+    image_type: Optional[str] = Form(None),
+    tags: Optional[str] = Form(None),
+    public_only: bool = Form(False),
+    deadline_ms: Optional[int] = Form(None)
+):
+    """Match uploaded image against stored images
+
+    nprobe trades recall for latency: more IVF cells probed means more candidates scored.
+    business_reference, image_type, tags (comma-separated, all required) and public_only
+    restrict the search to part of the catalog. deadline_ms caps the time spent on the
+    request: the most promising candidates are scored first and the best match found when
+    the budget runs out is returned, with search_exhaustive false.
+    """
+    deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms else None
     try:
-        # Read uploaded image
-        image_data = await image.read()
-        uploaded_img = Image.open(io.BytesIO(image_data))
-        
-        # Get all stored images (removed is_public filter for now)
-        db = SessionLocal()
-        stored_images = db.query(ExtractedImage).all()
-        db.close()
+        # Read uploaded image, never more than the limit; decoding and scoring happen in
+        # the match worker pool
+        image_data = await image.read(MAX_QUERY_BYTES + 1)
+        if len(image_data) > MAX_QUERY_BYTES:
+            return {"error": f"Image is larger than {MAX_QUERY_BYTES // (1024 * 1024)} MB"}
         
         best_match = None
         best_similarity = 0.0
-        threshold = 0.7  # Higher threshold for more accurate matching
+        threshold = MATCH_THRESHOLD  # Higher threshold for more accurate matching
+        
+        # Decode and fingerprint the scan off the event loop; frames too dark, washed out,
+        # blank or blurry to match are turned away before any scoring, and repeat scans of
+        # the same print are answered from the cache
+        try:
+            query_features = await match_executor.extract_image(image_data)
+        except FrameQualityError as e:
+            print(f"Rejected scan ({e.reason}): {e.metrics}")
+            return {
+                "match_found": False,
+                "rejected": True,
+                "reason": e.reason,
+                "message": str(e)
+            }
+        scope = match_scope(business_reference, image_type, tags, public_only)
+        cached = query_cache.get(
+            query_features, scope, nprobe,
+            is_valid=lambda image_id: not feature_store.missing([image_id]) and response_cache.is_current(image_id)
+        )
+        if cached is not None:
+            print(f"Cache hit: {cached[1]['image_path']}")
+            popularity.record_hit(cached[0])
+            return cached[1]
         
-        print(f"Processing {len(stored_images)} stored images...")
+        # Score the prefiltered candidates (pHash neighbours + IVF cells) in the worker pool;
+        # the scope is applied inside the indexes, before anything is scored. The most
+        # popular images are tried first and a certain hit among them ends the search
+        ids, similarities, stage_counts = await match_executor.score_features(
+            query_features, nprobe=nprobe, scope=scope, deadline=deadline, priority=popularity.top()
+        )
+        exhaustive = stage_counts["exhaustive"]
         
-        # Add some randomization to avoid false positives
-        import random
-        random.seed(42)  # Fixed seed for reproducibility
+        if stage_counts["early_exit"]:
+            print(f"Certain match after {stage_counts['popular_scored']} popular images, index search skipped")
+        else:
+            print(
+                f"Processing {stage_counts['candidates']} candidate images "
+                f"(after {stage_counts['popular_scored']} popular ones): "
+                f"{stage_counts['pruned_thumb8']} pruned at 8x8, {stage_counts['pruned_thumb16']} at 16x16, "
+                f"{stage_counts['pruned_best']} by the running best, {stage_counts['scored']} fully scored, "
+                f"{stage_counts.get('tile_scored', 0)} sub-page tiles scored"
+            )
+        if not exhaustive:
+            print(f"⏱️ Deadline of {deadline_ms} ms reached, {stage_counts['skipped_deadline']} candidates not scored")
         
-        for stored_img in stored_images:
-            try:
-                # Load stored image
-                if os.path.exists(stored_img.image_path):
-                    stored_image = Image.open(stored_img.image_path)
-                    
-                    # Calculate similarity
-                    similarity = calculate_image_similarity(uploaded_img, stored_image)
-                    
-                    # Add small random noise to break ties and avoid false positives
-                    noise = random.uniform(-0.01, 0.01)
-                    similarity += noise
-                    similarity = max(0, min(1, similarity))
-                    
-                    print(f"Image {stored_img.image_path}: similarity = {similarity:.3f}")
-                    
-                    if similarity > best_similarity and similarity >= threshold:
-                        best_similarity = similarity
-                        best_match = stored_img
-                        print(f"New best match: {stored_img.image_path} with similarity {similarity:.3f}")
-                        
-            except Exception as e:
-                print(f"Error processing stored image {stored_img.image_path}: {e}")
-                continue
+        # Add small random noise to break ties and avoid false positives
+        rng = np.random.default_rng(42)  # Fixed seed for reproducibility
+        similarities = np.clip(similarities + rng.uniform(-TIE_BREAK_NOISE, TIE_BREAK_NOISE, len(similarities)), 0, 1)
+        
+        # Only candidates above the threshold are hydrated, from the precomputed payloads
+        order = np.argsort(-similarities, kind='stable')
+        order = order[similarities[order] >= threshold]
+        if len(order):
+            payloads = response_cache.get_many(ids[order])
+            
+            # Images with more tags than the index stores exactly only passed a Bloom filter there;
+            # confirm the tags on the hydrated payloads
+            wanted_tags = split_tags(tags)
+            if wanted_tags:
+                payloads = {
+                    image_id: payload for image_id, payload in payloads.items()
+                    if wanted_tags <= split_tags(payload["image"]["tags"])
+                }
+            
+            # Best candidate that still exists in the database
+            for row in order:
+                if int(ids[row]) in payloads:
+                    best_similarity = float(similarities[row])
+                    best_match = payloads[int(ids[row])]
+                    print(f"New best match: {best_match['image']['image_path']} with similarity {best_similarity:.3f}")
+                    break
         
         if best_match:
             # Check if similarity is suspiciously high (might be the same image)
-            if best_similarity > 0.95:
+            if best_similarity > DUPLICATE_THRESHOLD:
                 print(f"⚠️ Warning: Very high similarity ({best_similarity:.3f}) - possible duplicate image")
             
-            # Get DEX content for the matched image
-            db = SessionLocal()
-            dex_content = db.query(DEXContent).filter(
-                DEXContent.image_id == best_match.id,
-                DEXContent.is_active == True
-            ).first()
-            db.close()
-            
-            response = {
-                "match_found": True,
-                "similarity_score": best_similarity,
-                "match_confidence": best_similarity,
-                "image_path": best_match.image_path,
-                "business_name": best_match.business_name,
-                "pdf_filename": best_match.pdf_filename,
-                "page_number": best_match.page_number,
-                "tags": best_match.tags,
-                "image_type": best_match.image_type,
-                "business_reference": best_match.business_reference,
-                "print_design_id": best_match.print_design_id,
-                "match_quality": "high" if best_similarity > 0.8 else "medium" if best_similarity > 0.6 else "low"
-            }
-            
-            # Add DEX content if available with enhanced delivery options
-            if dex_content:
-                response["dex_content"] = {
-                    "id": dex_content.id,
-                    "title": dex_content.title,
-                    "description": dex_content.description,
-                    "content_type": dex_content.content_type,
-                    "content_url": dex_content.content_url,
-                    "content_data": dex_content.content_data,
-                    "delivery_options": {
-                        "ar_enabled": dex_content.content_type in ["ar", "3d_model"],
-                        "video_available": dex_content.content_type == "video",
-                        "webpage_available": dex_content.content_url is not None,
-                        "direct_link": f"/dex/deliver/{dex_content.id}",
-                        "ar_link": f"/dex/ar/{dex_content.id}" if dex_content.content_type in ["ar", "3d_model"] else None,
-                        "qr_code": f"/dex/qr/{dex_content.id}"
-                    }
-                }
-            else:
-                # Provide fallback DEX options even without specific content
-                response["dex_content"] = {
-                    "id": None,
-                    "title": f"Learn more about {best_match.business_name}",
-                    "description": f"Discover more about this {best_match.image_type} from {best_match.business_name}",
-                    "content_type": "webpage",
-                    "content_url": f"/business/{best_match.business_reference}",
-                    "content_data": None,
-                    "delivery_options": {
-                        "ar_enabled": False,
-                        "video_available": False,
-                        "webpage_available": True,
-                        "direct_link": f"/business/{best_match.business_reference}",
-                        "ar_link": None,
-                        "qr_code": f"/dex/qr/business/{best_match.business_reference}"
-                    }
-                }
+            popularity.record_hit(best_match["image_id"])
+            response = match_response(best_match, best_similarity)
+            response["search_exhaustive"] = exhaustive
+            # A search cut short by its deadline is not the answer to cache
+            if exhaustive:
+                query_cache.put(query_features, best_match["image_id"], response, scope, nprobe)
             
             return response
         else:
             return {
                 "match_found": False,
-                "message": "No match found above threshold"
+                "message": "No match found above threshold",
+                "search_exhaustive": exhaustive
             }
             
     except Exception as e:
         return {"error": f"Error processing image: {str(e)}"}
 
+@app.post("/match-image/batch")
+async def match_image_batch(
+    images: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    top_k: int = Form(5),
+    nprobe: Optional[int] = Form(None),
+    business_reference: Optional[str] = Form(None),
+    image_type: Optional[str] = Form(None),
+    tags: Optional[str] = Form(None),
+    public_only: bool = Form(False)
+):
+    """Match many scans in one request
+
+    Send the scans as repeated "images" parts and/or a zip file as "archive". Returns up to
+    top_k matches above the threshold for every scan, in upload order. Scope fields work as
+    on /match-image/.
+    """
+    if top_k < 1:
+        return {"error": "top_k must be at least 1"}
+    if nprobe is not None and not 1 <= nprobe <= IVF_MAX_NPROBE:
+        return {"error": f"nprobe must be between 1 and {IVF_MAX_NPROBE}"}
+    try:
+        # Count the scans and size up what would be read from the uploads' and the zip's
+        # headers, before anything is read or inflated
+        uploads = images or []
+        entries = []
+        zf = None
+        if archive is not None:
+            archive_data = await archive.read(MAX_BATCH_ARCHIVE_BYTES + 1)
+            if len(archive_data) > MAX_BATCH_ARCHIVE_BYTES:
+                return {"error": f"Archive is larger than {MAX_BATCH_ARCHIVE_BYTES // (1024 * 1024)} MB"}
+            zf = zipfile.ZipFile(io.BytesIO(archive_data))
+            entries = [
+                info for info in zf.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(BATCH_IMAGE_EXTENSIONS)
+            ]
+        
+        if not uploads and not entries:
+            return {"error": "No images provided"}
+        if len(uploads) + len(entries) > MAX_BATCH_IMAGES:
+            return {"error": f"At most {MAX_BATCH_IMAGES} images per batch"}
+        # Reads stop one byte past the per-image limit and oversized entries are never inflated
+        total_bytes = sum(
+            min(upload.size if upload.size is not None else MAX_QUERY_BYTES, MAX_QUERY_BYTES + 1) for upload in uploads
+        ) + sum(info.file_size for info in entries if info.file_size <= MAX_QUERY_BYTES)
+        if total_bytes > MAX_BATCH_TOTAL_BYTES:
+            return {"error": f"Batch is larger than {MAX_BATCH_TOTAL_BYTES // (1024 * 1024)} MB in total"}
+        
+        names, blobs = [], []
+        for upload in uploads:
+            names.append(upload.filename)
+            blobs.append(await upload.read(MAX_QUERY_BYTES + 1))
+        if zf is not None:
+            with zf:
+                for info in entries:
+                    names.append(info.filename)
+                    # Oversized entries are reported below without being inflated
+                    blobs.append(zf.read(info) if info.file_size <= MAX_QUERY_BYTES else None)
+        
+        valid = [i for i, blob in enumerate(blobs) if blob is not None and len(blob) <= MAX_QUERY_BYTES]
+        scope = match_scope(business_reference, image_type, tags, public_only)
+        scored, stage_counts = await match_executor.score_images([blobs[i] for i in valid], nprobe=nprobe, scope=scope)
+        results = {i: result for i, result in zip(valid, scored)}
+        
+        print(
+            f"Batch of {len(names)} images: {stage_counts.get('candidates', 0)} candidate pairs, "
+            f"{stage_counts.get('pruned_bound', 0)} pruned by bounds, {stage_counts.get('scored', 0)} fully scored, "
+            f"{stage_counts.get('tile_scored', 0)} sub-page tiles scored"
+        )
+        
+        # Rank each scan's candidates above the threshold, with the same tie-break noise as match_image
+        ranked = {}
+        for i, result in results.items():
+            if isinstance(result, (str, dict)):
+                continue
+            ids, similarities = result
+            rng = np.random.default_rng(42)
+            similarities = np.clip(similarities + rng.uniform(-TIE_BREAK_NOISE, TIE_BREAK_NOISE, len(similarities)), 0, 1)
+            order = np.argsort(-similarities, kind='stable')
+            ranked[i] = [(int(ids[row]), float(similarities[row])) for row in order if similarities[row] >= MATCH_THRESHOLD]
+        
+        # Every matched image hydrated from the precomputed payloads at once
+        payloads = response_cache.get_many({image_id for matches in ranked.values() for image_id, _ in matches})
+        
+        wanted_tags = split_tags(tags)
+        response = []
+        for i, name in enumerate(names):
+            if i not in results:
+                response.append({"filename": name, "error": f"Image is larger than {MAX_QUERY_BYTES // (1024 * 1024)} MB"})
+                continue
+            if isinstance(results[i], str):
+                response.append({"filename": name, "error": results[i]})
+                continue
+            if isinstance(results[i], dict):
+                response.append({"filename": name, "rejected": True, **results[i]})
+                continue
+            
+            matches = []
+            for image_id, similarity in ranked[i]:
+                payload = payloads.get(image_id)
+                if payload is None or (wanted_tags and not wanted_tags <= split_tags(payload["image"]["tags"])):
+                    continue
+                matches.append({
+                    "image_id": image_id,
+                    "similarity_score": similarity,
+                    **payload["image"],
+                    "match_quality": "high" if similarity > 0.8 else "medium" if similarity > 0.6 else "low",
+                    "dex_content": payload["dex_content"]
+                })
+                if len(matches) == top_k:
+                    break
+            response.append({"filename": name, "match_found": bool(matches), "matches": matches})
+            if matches:
+                popularity.record_hit(matches[0]["image_id"])
+        
+        return {
+            "total_images": len(names),
+            "matched_images": sum(1 for result in response if result.get("match_found")),
+            "results": response
+        }
+        
+    except Exception as e:
+        return {"error": f"Error processing batch: {str(e)}"}
+
+@app.websocket("/ws/live-scan")
+async def live_scan(websocket: WebSocket):
+    """Continuous camera scanning
+
+    The client sends small JPEG frames as binary messages, one at a time, and waits for the
+    reply to each. Every frame gets a {"type": "frame"} event; once the same image has won
+    several frames in a row a {"type": "match"} event carries the usual /match-image/ body.
+    Scope fields and nprobe can be given as query parameters.
+    """
+    await websocket.accept()
+    params = websocket.query_params
+    scope = match_scope(
+        params.get("business_reference"),
+        params.get("image_type"),
+        params.get("tags"),
+        params.get("public_only", "").lower() in ("1", "true", "yes")
+    )
+    wanted_tags = split_tags(params.get("tags"))
+    nprobe = params.get("nprobe")
+    if nprobe:
+        if not nprobe.isdecimal() or not 1 <= int(nprobe) <= IVF_MAX_NPROBE:
+            await websocket.send_json({"type": "error", "message": f"nprobe must be between 1 and {IVF_MAX_NPROBE}"})
+            await websocket.close(code=1008)
+            return
+        nprobe = int(nprobe)
+    session = LiveScanSession(scope=scope, nprobe=nprobe or None)
+    
+    try:
+        while True:
+            frame = await websocket.receive_bytes()
+            if len(frame) > MAX_LIVE_FRAME_BYTES:
+                await websocket.send_json({"type": "error", "message": "Frame is too large, downscale it first"})
+                continue
+            try:
+                event = await session.process(frame)
+            except Exception as e:
+                await websocket.send_json({"type": "error", "message": f"Error processing frame: {str(e)}"})
+                continue
+            
+            if event.pop("announce") and event["similarity"] >= MATCH_THRESHOLD:
+                payload = response_cache.get(event["candidate_id"])
+                if payload and (not wanted_tags or wanted_tags <= split_tags(payload["image"]["tags"])):
+                    popularity.record_hit(event["candidate_id"])
+                    await websocket.send_json({"type": "match", **match_response(payload, event["similarity"])})
+                    continue
+            await websocket.send_json(event)
+    except WebSocketDisconnect:
+        pass
+
 @app.post("/upload/")
 async def upload_pdf(
     file: UploadFile = File(...),
     business_name: str = Form(...),
     business_reference: str = Form(...),
     tags: str = Form(""),
-    image_type: str = Form("logo")
+    image_type: str = Form("logo"),
+    dpi: Optional[float] = Form(None),
+    max_dimension: Optional[int] = Form(None),
+    alpha: Optional[bool] = Form(None),
+    image_format: str = Form("png"),
+    image_quality: Optional[int] = Form(None),
+    extraction_mode: str = Form("pages")
 ):
-    """Upload a PDF and extract images"""
+    """Upload a PDF and extract images
+
+    dpi or max_dimension (longest side in pixels), alpha (on by default, off for jpeg),
+    image_format (png, jpeg, webp) and image_quality (PNG compression level or JPEG/WebP
+    quality) set how pages are stored.
+    extraction_mode "embedded" indexes the images embedded in the PDF instead of its pages,
+    each with its page number and bounding box; "both" indexes pages and images.
+    """
+    try:
+        settings = render_settings(dpi, max_dimension, alpha, image_format, image_quality, extraction_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     db = SessionLocal()
     
     pdf_path = os.path.join(UPLOAD_DIR, file.filename)
     with open(pdf_path, "wb") as buffer:
         shutil.copyfileobj(file.file, buffer)
 
-    images_info = extract_images_from_pdf(pdf_path, IMAGE_DIR)
+    images_info = extract_images_from_pdf(pdf_path, IMAGE_DIR, settings=settings)
 
+    image_records = []
     for info in images_info:
         image_record = ExtractedImage(
             image_path=info["image_path"],
@@ -283,18 +458,21 @@ async def upload_pdf(
             image_type=image_type,
             business_name=business_name,
             business_reference=business_reference,
-            uploaded_at=datetime.utcnow()
+            uploaded_at=datetime.utcnow(),
+            **info["render"]
         )
         db.add(image_record)
+        image_records.append(image_record)
     db.commit()
+    confusable = index_ingested(image_records, images_info)
     db.close()
 
-    return {"message": f"{len(images_info)} image(s) extracted and stored."}
+    return {"message": f"{len(images_info)} image(s) extracted and stored.", "confusable_pages": confusable}
 
 @app.post("/process-all/")
 async def process_all_pdfs():
     """Process all PDFs in the pdfs folder"""
-    from imageprocessing.batch_processor import process_all_pdfs
+    from batch_processor import process_all_pdfs
     process_all_pdfs()
     return {"message": "All PDFs processed successfully"}
 
@@ -309,6 +487,8 @@ async def get_images():
         {
             "id": img.id,
             "image_path": img.image_path,
+            # Pages ingested before thumbnails existed fall back to the full image
+            "thumbnail_path": thumbnail_path(img.image_path) if os.path.exists(thumbnail_path(img.image_path)) else img.image_path,
             "pdf_filename": img.pdf_filename,
             "page_number": img.page_number,
             "tags": img.tags,
@@ -406,9 +586,22 @@ async def upload_pdf(
     business_name: str = Form(...),
     business_reference: str = Form(""),
     tags: str = Form(""),
-    image_type: str = Form("logo")
+    image_type: str = Form("logo"),
+    dpi: Optional[float] = Form(None),
+    max_dimension: Optional[int] = Form(None),
+    alpha: Optional[bool] = Form(None),
+    image_format: str = Form("png"),
+    image_quality: Optional[int] = Form(None),
+    extraction_mode: str = Form("pages")
 ):
-    """Upload and process PDF file"""
+    """Upload and process PDF file
+
+    The render settings are the same as for /upload/.
+    """
+    try:
+        settings = render_settings(dpi, max_dimension, alpha, image_format, image_quality, extraction_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     try:
         # Validate file type
         if not file.filename.endswith('.pdf'):
@@ -427,7 +620,7 @@ async def upload_pdf(
         os.makedirs(output_dir, exist_ok=True)
         
         # Extract images from PDF using the correct function signature
-        extracted_images_info = extract_images_from_pdf(temp_file_path, output_dir)
+        extracted_images_info = extract_images_from_pdf(temp_file_path, output_dir, settings=settings)
         
         # Store extracted images in database
         db = SessionLocal()
@@ -444,7 +637,8 @@ async def upload_pdf(
                     page_number=img_info["page_number"],
                     tags=tags,
                     image_type=image_type,
-                    is_public=True
+                    is_public=True,
+                    **img_info["render"]
                 )
                 db.add(new_image)
                 stored_images.append(new_image)
@@ -455,6 +649,9 @@ async def upload_pdf(
             for img in stored_images:
                 db.refresh(img)
             
+            # Pages a scan could mistake for an existing one, so the uploader can dedupe
+            confusable = index_ingested(stored_images, extracted_images_info)
+            
         except Exception as db_error:
             db.rollback()
             raise HTTPException(status_code=500, detail=f"Database error: {str(db_error)}")
@@ -533,7 +730,8 @@ async def upload_pdf(
                     "image_path": img.image_path,
                     "page_number": img.page_number
                 } for img in stored_images
-            ]
+            ],
+            "confusable_pages": confusable
         }
         
     except Exception as e:
@@ -560,6 +758,11 @@ async def api_root():
         }
     }
 
+@app.get("/api/match-cache")
+async def match_cache_stats():
+    """Hit/miss counters and size of the repeat-scan cache"""
+    return query_cache.stats()
+
 @app.get("/test-match")
 async def test_match():
     """Test endpoint to check if matching logic works"""
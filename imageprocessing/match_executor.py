@@ -0,0 +1,177 @@
+"""
+Process pool for image matching
+Decoding and scoring are CPU-bound, so they run in worker processes that keep the catalog
+features loaded. The uploaded bytes reach a worker through shared memory rather than being
+pickled down the pool's pipe; the asyncio handler only awaits the result.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+try:
+    from matcher import catalog_matcher, tile_matcher
+    from utils.image_features import extract_features, decode_query_image, check_frame_quality, crop_to_page, FrameQualityError
+except ImportError:
+    from .matcher import catalog_matcher, tile_matcher
+    from .utils.image_features import extract_features, decode_query_image, check_frame_quality, crop_to_page, FrameQualityError
+
+MATCH_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+BATCH_GROUP_SIZE = 16  # Queries decoded and scored together by one worker
+
+
+def _init_worker():
+    """Load the catalog and its tiles and build their indexes once per worker process"""
+    catalog_matcher.catalog()
+    tile_matcher.catalog()
+
+
+def _prepare_query(image_data: bytes):
+    """Decode a query frame and cut out the printed page
+
+    Raises FrameQualityError before any work is spent on a bad frame.
+    """
+    img = decode_query_image(image_data)
+    check_frame_quality(img)
+    return crop_to_page(img)
+
+
+def _extract_in_worker(shm_name: str, size: int):
+    """Decode the query from shared memory, check and crop it, and compute its descriptors"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image_data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return extract_features(_prepare_query(image_data))
+
+
+def _score_features_in_worker(query_features: dict, nprobe: int = None, scope: dict = None, shortlist=None,
+                              deadline: float = None, priority=None):
+    """Score descriptors that were already extracted, e.g. from a small live-scan frame"""
+    return catalog_matcher.score(
+        query_features, scope=scope, nprobe=nprobe, shortlist=shortlist, deadline=deadline, priority=priority
+    )
+
+
+def _match_many_in_worker(shm_name: str, spans: list, nprobe: int = None, scope: dict = None):
+    """Decode a group of queries from shared memory and score them together
+
+    Returns one entry per span: (image_ids, similarities), an error message for a frame
+    that could not be decoded, or {"reason", "message"} for one that failed the quality
+    check; plus the group's stage counts.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        blobs = [bytes(shm.buf[start:stop]) for start, stop in spans]
+    finally:
+        shm.close()
+
+    results = [None] * len(blobs)
+    queries = []
+    positions = []
+    for position, image_data in enumerate(blobs):
+        try:
+            queries.append(extract_features(_prepare_query(image_data)))
+            positions.append(position)
+        except FrameQualityError as e:
+            results[position] = {"reason": e.reason, "message": str(e)}
+        except Exception as e:
+            results[position] = f"Error processing image: {e}"
+
+    scored, stats = catalog_matcher.score_many(queries, scope=scope, nprobe=nprobe)
+    for position, result in zip(positions, scored):
+        results[position] = result
+    return results, stats
+
+
+class MatchExecutor:
+    """Lazily started process pool that scores uploaded images"""
+
+    def __init__(self, max_workers: int = MATCH_WORKERS):
+        self.max_workers = max_workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # Spawned, not forked: the pool starts lazily, after the compactor threads, and a
+                # fork taken while one of them holds a store lock would deadlock the worker
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers, initializer=_init_worker,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    async def extract_image(self, image_data: bytes) -> dict:
+        """Decode an uploaded image and compute its descriptors without blocking the event loop
+
+        Raises FrameQualityError for a frame too dark, washed out, blank or blurry to match.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(image_data)))
+        try:
+            shm.buf[:len(image_data)] = image_data
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_pool(), _extract_in_worker, shm.name, len(image_data))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    async def score_features(self, query_features: dict, nprobe: int = None, scope: dict = None, shortlist=None,
+                             deadline: float = None, priority=None):
+        """Return (image_ids, similarities, stage_counts) for query descriptors
+
+        scope comes from matcher.match_scope() and is enforced inside the indexes. deadline
+        is a time.monotonic() value; the monotonic clock is system-wide, so it holds in the
+        worker process too. priority lists popular image ids to try first.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_pool(), _score_features_in_worker, query_features, nprobe, scope, shortlist, deadline, priority
+        )
+
+    async def score_images(self, images_data: list, nprobe: int = None, scope: dict = None):
+        """Score many uploaded images, decoding and scoring groups of them in parallel workers
+
+        Returns a list with (image_ids, similarities), an error message or a quality rejection
+        per image, and the summed stage counts.
+        """
+        offsets = np.cumsum([0] + [len(image_data) for image_data in images_data])
+        shm = shared_memory.SharedMemory(create=True, size=max(1, int(offsets[-1])))
+        try:
+            for image_data, start in zip(images_data, offsets):
+                shm.buf[start:start + len(image_data)] = image_data
+            spans = [(int(start), int(stop)) for start, stop in zip(offsets[:-1], offsets[1:])]
+            loop = asyncio.get_running_loop()
+            pool = self._get_pool()
+            groups = await asyncio.gather(*[
+                loop.run_in_executor(
+                    pool, _match_many_in_worker, shm.name, spans[start:start + BATCH_GROUP_SIZE], nprobe, scope
+                )
+                for start in range(0, len(spans), BATCH_GROUP_SIZE)
+            ])
+        finally:
+            shm.close()
+            shm.unlink()
+
+        results = []
+        stats = {}
+        for group_results, group_stats in groups:
+            results.extend(group_results)
+            for name, count in group_stats.items():
+                stats[name] = stats.get(name, 0) + count
+        return results, stats
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+match_executor = MatchExecutor()
@@ -0,0 +1,455 @@
+"""
+Catalog matcher
+Narrows the catalog with a perceptual-hash prefilter and an IVF vector index, then scores the
+survivors with the batched kernel. Sub-page tiles go through a second matcher with the same
+indexes, and each page takes the best score of itself and its tiles.
+"""
+
+import threading
+import time
+import numpy as np
+
+try:
+    from feature_store import feature_store, attribute_code, tag_mask, split_tags, TAG_SLOTS
+    from tile_store import tile_store, tile_keys, parent_ids
+    from utils.hash_index import HammingIndex
+    from utils.ivf_index import IVFIndex
+    from utils.similarity import (
+        score_batch, score_matrix, histogram_similarity, histogram_matrix, upper_bounds, upper_bound_matrix
+    )
+except ImportError:
+    from .feature_store import feature_store, attribute_code, tag_mask, split_tags, TAG_SLOTS
+    from .tile_store import tile_store, tile_keys, parent_ids
+    from .utils.hash_index import HammingIndex
+    from .utils.ivf_index import IVFIndex
+    from .utils.similarity import (
+        score_batch, score_matrix, histogram_similarity, histogram_matrix, upper_bounds, upper_bound_matrix
+    )
+
+MATCH_THRESHOLD = 0.7  # Minimum similarity for a match
+DUPLICATE_THRESHOLD = 0.95  # Above this the scan is most likely the stored image itself
+PREFILTER_TOP_K = 64  # Hamming neighbours that get the full four-metric score
+TIE_BREAK_NOISE = 0.01  # Amplitude of the noise match_image adds to break ties
+CASCADE_BATCH = 16  # Rows scored at full resolution between running-best checks
+CERTAIN_MATCH_THRESHOLD = 0.99  # A popular image scoring this high ends the search at once...
+CERTAIN_MATCH_MARGIN = 0.05  # ...if no other popular image scores, or could score, within this of it
+POPULAR_BATCH = 4  # Popular rows scored between certain-match checks
+
+
+def match_scope(business_reference: str = None, image_type: str = None, tags: str = None,
+                public_only: bool = False) -> dict:
+    """Encode optional scope predicates the way the feature store records them; None if unscoped"""
+    scope = {
+        "business_reference": attribute_code(business_reference),
+        "image_type": attribute_code(image_type),
+        "tag_bits": tag_mask(tags),
+        "tag_codes": tuple(sorted(attribute_code(tag) for tag in split_tags(tags))),
+        "public_only": bool(public_only),
+    }
+    return scope if any(scope.values()) else None
+
+
+def _best_per_image(image_ids: np.ndarray, similarities: np.ndarray):
+    """Keep the highest similarity of every image id"""
+    order = np.lexsort((-similarities, image_ids))
+    image_ids, similarities = image_ids[order], similarities[order]
+    first = np.ones(len(image_ids), dtype=bool)
+    first[1:] = image_ids[1:] != image_ids[:-1]
+    return image_ids[first], similarities[first]
+
+
+def _partition(codes: np.ndarray, offset: int = 0) -> dict:
+    """Group row numbers by attribute code"""
+    order = np.argsort(codes, kind='stable')
+    values, starts = np.unique(codes[order], return_index=True)
+    return {
+        value: (part + offset).tolist()
+        for value, part in zip(values.tolist(), np.split(order, starts[1:]))
+    }
+
+
+class CatalogMatcher:
+    """Candidate selection and scoring over the feature store"""
+
+    def __init__(self, store=feature_store, top_k: int = PREFILTER_TOP_K, tiles=None):
+        self.store = store
+        self.top_k = top_k
+        self.tiles = tiles  # Matcher over the sub-page tiles of this catalog, if any
+        self._lock = threading.RLock()
+        self._generation = None
+        self._catalog = None
+        self._hash_index = None
+        self._ivf = None
+        self._partitions = {}  # Business reference code -> catalog rows, dead rows included
+        self._rows_by_id = {}  # Image id -> live catalog row
+
+    def catalog(self) -> dict:
+        """Current feature snapshot, bringing the indexes up to date if the store changed"""
+        snapshot = self.store.snapshot()
+        with self._lock:
+            if snapshot["generation"] != self._generation:
+                self._refresh(snapshot)
+                self._catalog = snapshot
+                self._generation = snapshot["generation"]
+            return self._catalog
+
+    def _refresh(self, snapshot: dict):
+        """Bring the indexes up to date in place: insert appended rows, tombstone dead ones"""
+        ids = snapshot["ids"]
+        alive = snapshot["alive"]
+        previous = self._catalog
+
+        if previous is None:
+            self._hash_index = HammingIndex(snapshot["phash"], alive)
+            self._ivf = IVFIndex()
+            self._ivf.train(snapshot["vector"], alive)
+            self._partitions = _partition(snapshot["business_reference"])
+            self._rows_by_id = {}
+            start = 0
+            died = np.zeros(0, dtype=np.int64)
+        else:
+            if snapshot["generation"][0] == self._generation[0]:
+                # Same snapshot, more log records: existing rows keep their numbers
+                start = len(previous["ids"])
+                died = np.flatnonzero(previous["alive"] & ~alive[:start])
+            else:
+                # Compaction dropped the tombstones and renumbered the survivors; keep the
+                # IVF cells and just rewrite the posting lists
+                start = self._compacted_prefix(previous, ids)
+                mapping = np.full(len(previous["ids"]), -1, dtype=np.int64)
+                mapping[np.flatnonzero(previous["alive"])[:start]] = np.arange(start)
+                self._ivf.remap(mapping, start)
+                self._hash_index = HammingIndex(snapshot["phash"][:start], alive[:start])
+                self._partitions = _partition(snapshot["business_reference"][:start])
+                self._rows_by_id = {}
+                self._index_rows(ids[:start], alive[:start], 0)
+                died = np.flatnonzero(~alive[:start])
+
+            self._hash_index.add(snapshot["phash"][start:], alive[start:])
+            self._ivf.add(snapshot["vector"][start:], alive[start:])
+            for code, rows in _partition(snapshot["business_reference"][start:], start).items():
+                self._partitions.setdefault(code, []).extend(rows)
+            self._hash_index.remove(died)
+            self._ivf.remove(died)
+
+        for row in died.tolist():
+            if self._rows_by_id.get(int(ids[row])) == row:
+                del self._rows_by_id[int(ids[row])]
+        self._index_rows(ids[start:], alive[start:], start)
+
+        # Periodic re-clustering as the catalog grows past what the cells were trained on
+        if self._ivf.needs_retrain():
+            print(f"Re-clustering IVF index over {int(alive.sum())} images...")
+            self._ivf.train(snapshot["vector"], alive)
+
+    def _index_rows(self, ids: np.ndarray, alive: np.ndarray, start: int):
+        for offset in np.flatnonzero(alive).tolist():
+            self._rows_by_id[int(ids[offset])] = start + offset
+
+    @staticmethod
+    def _compacted_prefix(previous: dict, ids: np.ndarray) -> int:
+        """Number of leading rows of a compacted snapshot that are the previous live rows, in order"""
+        live_ids = previous["ids"][previous["alive"]]
+        count = min(len(live_ids), len(ids))
+        mismatch = np.flatnonzero(live_ids[:count] != ids[:count])
+        return int(mismatch[0]) if len(mismatch) else count
+
+    def rows_for_ids(self, image_ids) -> np.ndarray:
+        """Live catalog rows of the given image ids; unknown or deleted ids are skipped"""
+        rows = [self._rows_by_id.get(int(image_id)) for image_id in image_ids]
+        return np.array([row for row in rows if row is not None], dtype=np.int64)
+
+    def scope_rows(self, scope: dict, catalog: dict) -> np.ndarray:
+        """Live rows satisfying the scope predicates
+
+        A business reference selects its partition first, so the bitmap filters below only
+        touch that tenant's rows.
+        """
+        if scope["business_reference"]:
+            rows = np.array(self._partitions.get(scope["business_reference"], []), dtype=np.int64)
+        else:
+            rows = np.arange(len(catalog["ids"]))
+        return self.filter_scope(rows, scope, catalog)
+
+    @staticmethod
+    def filter_scope(rows: np.ndarray, scope: dict, catalog: dict) -> np.ndarray:
+        """The given rows that are live and satisfy the scope predicates, in their order"""
+        keep = catalog["alive"][rows]
+        if scope["business_reference"]:
+            keep &= catalog["business_reference"][rows] == np.uint64(scope["business_reference"])
+        if scope["image_type"]:
+            keep &= catalog["image_type"][rows] == np.uint64(scope["image_type"])
+        if scope["tag_codes"]:
+            # Exact tag codes; rows with more tags than TAG_SLOTS fall back to their Bloom filter
+            bits = np.uint64(scope["tag_bits"])
+            overflow = catalog["tag_count"][rows] > TAG_SLOTS
+            keep &= CatalogMatcher.tags_verified(rows, scope, catalog) | (
+                overflow & ((catalog["tag_bits"][rows] & bits) == bits)
+            )
+        if scope["public_only"]:
+            keep &= catalog["is_public"][rows].astype(bool)
+        return rows[keep]
+
+    @staticmethod
+    def tags_verified(rows: np.ndarray, scope: dict, catalog: dict) -> np.ndarray:
+        """Mask of the rows whose stored tag codes hold every tag of the scope"""
+        verified = np.ones(len(rows), dtype=bool)
+        if scope and scope["tag_codes"]:
+            codes = catalog["tag_codes"][rows]
+            for code in scope["tag_codes"]:
+                verified &= (codes == np.uint64(code)).any(axis=1)
+        return verified
+
+    def candidates(self, query_features: dict, catalog: dict, nprobe: int = None,
+                   in_scope: np.ndarray = None) -> np.ndarray:
+        """Rows of the catalog worth a full score: nearest pHashes plus the closest IVF cells
+
+        in_scope restricts the search to the given rows inside both indexes.
+        """
+        allowed = None
+        if in_scope is None:
+            if len(self._hash_index) <= self.top_k:
+                return np.flatnonzero(catalog["alive"])
+        else:
+            if len(in_scope) <= self.top_k:
+                return in_scope
+            allowed = np.zeros(len(catalog["ids"]), dtype=bool)
+            allowed[in_scope] = True
+
+        rows, _ = self._hash_index.search(int(query_features["phash"]), self.top_k, allowed)
+        if self._ivf.trained:
+            rows = np.union1d(rows, self._ivf.search(query_features["vector"], nprobe, allowed))
+        return rows
+
+    def scan_popular(self, query_features: dict, catalog: dict, rows: np.ndarray,
+                     certain: float = CERTAIN_MATCH_THRESHOLD, verified: np.ndarray = None):
+        """Score popular rows in popularity order, stopping at the first certain match
+
+        A hit is certain when its row is verified (parallel to rows, see tags_verified), it
+        scores at least certain and no other popular row scores or can still score within
+        CERTAIN_MATCH_MARGIN of it, so a popular near-duplicate cannot take the scan. Rows
+        whose upper bound is too low to matter are left for the regular cascade. Returns
+        (rows, similarities) of the scored rows and whether a certain match was found.
+        """
+        verified = np.ones(len(rows), dtype=bool) if verified is None else verified
+        if len(rows):
+            hist_similarity = histogram_similarity(query_features, catalog["hist"][rows])
+            bound = upper_bounds(query_features, catalog["stats"][rows], catalog["thumb16"][rows], hist_similarity)
+            keep = bound >= certain - CERTAIN_MATCH_MARGIN
+            rows, bound, verified = rows[keep], bound[keep], verified[keep]
+        similarities = []
+        for start in range(0, len(rows), POPULAR_BATCH):
+            batch = rows[start:start + POPULAR_BATCH]
+            similarities.append(score_batch(
+                query_features,
+                catalog["gray"][batch],
+                catalog["hist"][batch],
+                catalog["grad"][batch]
+            ))
+            scored = np.concatenate(similarities)
+            count = len(scored)
+            top = np.where(verified[:count], scored, -np.inf).argmax()
+            if verified[top] and scored[top] >= certain:
+                rivals = np.delete(scored, top) >= scored[top] - CERTAIN_MATCH_MARGIN
+                if not rivals.any() and not (bound[count:] >= scored[top] - CERTAIN_MATCH_MARGIN).any():
+                    return rows[:count], scored, True
+        similarities = np.concatenate(similarities) if similarities else np.zeros(0, dtype=np.float32)
+        return rows, similarities, False
+
+    def cascade(self, query_features: dict, catalog: dict, rows: np.ndarray, floor: float = MATCH_THRESHOLD,
+                deadline: float = None, best: float = -np.inf, verified: np.ndarray = None):
+        """Score rows coarse-to-fine, skipping rows whose upper bound cannot matter
+
+        A row is pruned once its bound falls below the threshold floor or below the running
+        best, both less the tie-break noise that match_image adds afterwards. Rows are fully
+        scored in order of decreasing bound; once the time.monotonic() deadline passes the
+        scan stops after the current batch (the first batch is always scored). Returns
+        (rows, similarities) of the fully scored rows and the per-stage counts, including
+        whether the scan was exhaustive. best seeds the running best with a score found
+        elsewhere, e.g. by scan_popular. verified, parallel to rows, marks the rows whose
+        scope was checked exactly (see tags_verified); only those raise the running best,
+        so a row that may be out of scope can never prune an in-scope one.
+        """
+        stats = {"candidates": len(rows)}
+        floor -= TIE_BREAK_NOISE
+        verified = np.ones(len(rows), dtype=bool) if verified is None else verified
+
+        # Stages 1 and 2: exact histogram term plus 8x8 then 16x16 thumbnail bounds
+        hist_similarity = histogram_similarity(query_features, catalog["hist"][rows])
+        bound = None
+        for name in ("thumb8", "thumb16"):
+            bound = upper_bounds(query_features, catalog["stats"][rows], catalog[name][rows], hist_similarity)
+            keep = bound >= floor
+            stats[f"pruned_{name}"] = int((~keep).sum())
+            rows, bound, hist_similarity, verified = rows[keep], bound[keep], hist_similarity[keep], verified[keep]
+
+        # Stage 3: full 64x64 score in order of decreasing bound until nothing left can
+        # overtake the best score seen so far
+        order = np.argsort(-bound, kind='stable')
+        rows, bound, verified = rows[order], bound[order], verified[order]
+        scored = 0
+        skipped = 0
+        similarities = []
+        while scored < len(rows):
+            cutoff = max(floor, best - 2 * TIE_BREAK_NOISE)
+            batch = rows[scored:scored + CASCADE_BATCH]
+            batch_verified = verified[scored:scored + len(batch)]
+            above = bound[scored:scored + len(batch)] >= cutoff
+            batch, batch_verified = batch[above], batch_verified[above]
+            if len(batch) == 0:
+                break
+            if scored and deadline is not None and time.monotonic() >= deadline:
+                # Out of time: everything left could still have overtaken the best
+                skipped = int((bound[scored:] >= cutoff).sum())
+                break
+            batch_similarities = score_batch(
+                query_features,
+                catalog["gray"][batch],
+                catalog["hist"][batch],
+                catalog["grad"][batch]
+            )
+            similarities.append(batch_similarities)
+            if batch_verified.any():
+                best = max(best, float(batch_similarities[batch_verified].max()))
+            # Rows cut from a partial batch are below the cutoff, as is everything after them
+            scored += len(batch)
+            if len(batch) < CASCADE_BATCH:
+                break
+        stats["pruned_best"] = len(rows) - scored - skipped
+        stats["skipped_deadline"] = skipped
+        stats["scored"] = scored
+        stats["exhaustive"] = skipped == 0
+
+        similarities = np.concatenate(similarities) if similarities else np.zeros(0, dtype=np.float32)
+        return rows[:scored], similarities, stats
+
+    def score(self, query_features: dict, scope: dict = None, allowed_ids=None, nprobe: int = None,
+              shortlist=None, deadline: float = None, priority=None, certain: float = CERTAIN_MATCH_THRESHOLD):
+        """Return (image_ids, similarities, stage_counts) for the candidates within the scope
+
+        Only rows that can still reach the match threshold are scored and returned. A
+        shortlist of image ids (already in scope) replaces the index search entirely. With a
+        deadline the most promising candidates are scored first and the rest are dropped
+        once it passes; stage_counts["exhaustive"] says whether that happened.
+
+        priority lists image ids to try first, most popular first; if one of them is a
+        certain match (see scan_popular), it is returned without searching the indexes at
+        all and stage_counts["early_exit"] is set.
+        """
+        with self._lock:
+            catalog = self.catalog()
+            popular = np.zeros(0, dtype=np.int64)
+            if priority is not None and shortlist is None:
+                popular = self.rows_for_ids(priority)
+                if scope:
+                    popular = self.filter_scope(popular, scope, catalog)
+
+        allowed = None if allowed_ids is None else np.fromiter(allowed_ids, dtype=np.int64)
+        if allowed is not None:
+            popular = popular[np.isin(catalog["ids"][popular], allowed)]
+
+        popular, popular_similarities, certain_hit = self.scan_popular(
+            query_features, catalog, popular, certain, verified=self.tags_verified(popular, scope, catalog)
+        )
+        if certain_hit:
+            stats = {"candidates": len(popular), "popular_scored": len(popular), "scored": len(popular),
+                     "early_exit": True, "exhaustive": True}
+            return catalog["ids"][popular], popular_similarities, stats
+
+        with self._lock:
+            if shortlist is not None:
+                rows = self.rows_for_ids(shortlist)
+            else:
+                in_scope = self.scope_rows(scope, catalog) if scope else None
+                rows = self.candidates(query_features, catalog, nprobe, in_scope)
+
+        if allowed is not None:
+            rows = rows[np.isin(catalog["ids"][rows], allowed)]
+
+        # Popular rows already have their score, the cascade only has to beat it
+        rows = rows[~np.isin(rows, popular)]
+        popular_verified = self.tags_verified(popular, scope, catalog)
+        best = float(popular_similarities[popular_verified].max()) if popular_verified.any() else -np.inf
+        rows, similarities, stats = self.cascade(
+            query_features, catalog, rows, deadline=deadline, best=best,
+            verified=self.tags_verified(rows, scope, catalog)
+        )
+        stats["popular_scored"] = len(popular)
+        stats["early_exit"] = False
+        scored_rows = np.concatenate([popular, rows])
+        image_ids = catalog["ids"][scored_rows]
+        similarities = np.concatenate([popular_similarities, similarities])
+
+        # Partial-page photos: search the tiles too, unless the page itself is a certain match
+        page_certain = (similarities[self.tags_verified(scored_rows, scope, catalog)] >= certain).any()
+        if self.tiles is not None and not page_certain:
+            if deadline is not None and time.monotonic() >= deadline:
+                stats["exhaustive"] = False
+            else:
+                tile_ids, tile_similarities, tile_stats = self.tiles.score(
+                    query_features, scope=scope, nprobe=nprobe, deadline=deadline,
+                    allowed_ids=None if allowed is None else tile_keys(allowed),
+                    shortlist=None if shortlist is None else tile_keys(shortlist)
+                )
+                stats["tile_candidates"] = tile_stats["candidates"]
+                stats["tile_scored"] = tile_stats["scored"]
+                stats["exhaustive"] = stats["exhaustive"] and tile_stats["exhaustive"]
+                image_ids, similarities = _best_per_image(
+                    np.concatenate([image_ids, parent_ids(tile_ids)]),
+                    np.concatenate([similarities, tile_similarities])
+                )
+        return image_ids, similarities, stats
+
+    def score_many(self, queries: list, scope: dict = None, nprobe: int = None, floor: float = MATCH_THRESHOLD):
+        """Score several queries together; returns [(image_ids, similarities)] per query and stage counts
+
+        The queries share one pass over the union of their candidates: bounds and the pixel
+        terms are matrix products over that union, and each query only keeps the rows that
+        were its own candidates and can still reach the threshold.
+        """
+        if not queries:
+            return [], {}
+        with self._lock:
+            catalog = self.catalog()
+            in_scope = self.scope_rows(scope, catalog) if scope else None
+            candidate_rows = [self.candidates(query, catalog, nprobe, in_scope) for query in queries]
+
+        union = np.unique(np.concatenate(candidate_rows))
+        mask = np.zeros((len(queries), len(union)), dtype=bool)
+        for i, rows in enumerate(candidate_rows):
+            mask[i, np.searchsorted(union, rows)] = True
+        stats = {"candidates": int(mask.sum())}
+
+        # Bound stage on the 16x16 thumbnails, for all pairs at once
+        hist_similarity = histogram_matrix(queries, catalog["hist"][union])
+        bound = upper_bound_matrix(queries, catalog["stats"][union], catalog["thumb16"][union], hist_similarity)
+        keep = mask & (bound >= floor - TIE_BREAK_NOISE)
+        stats["pruned_bound"] = stats["candidates"] - int(keep.sum())
+
+        # Full score for the surviving pairs, restricted to rows some query still wants
+        needed = np.flatnonzero(keep.any(axis=0))
+        keep = keep[:, needed]
+        rows = union[needed]
+        scores = score_matrix(queries, catalog["gray"][rows], catalog["hist"][rows], catalog["grad"][rows], keep)
+        stats["scored"] = int(keep.sum())
+
+        results = []
+        for i in range(len(queries)):
+            wanted = np.flatnonzero(keep[i])
+            results.append((catalog["ids"][rows[wanted]], scores[i, wanted]))
+
+        if self.tiles is not None:
+            tile_results, tile_stats = self.tiles.score_many(queries, scope=scope, nprobe=nprobe, floor=floor)
+            for name, count in tile_stats.items():
+                stats[f"tile_{name}"] = count
+            results = [
+                _best_per_image(
+                    np.concatenate([image_ids, parent_ids(tile_ids)]),
+                    np.concatenate([similarities, tile_similarities])
+                )
+                for (image_ids, similarities), (tile_ids, tile_similarities) in zip(results, tile_results)
+            ]
+        return results, stats
+
+tile_matcher = CatalogMatcher(tile_store)
+catalog_matcher = CatalogMatcher(tiles=tile_matcher)
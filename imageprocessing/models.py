@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Float
 from sqlalchemy.orm import relationship
 try:
     from database import Base
@@ -86,6 +86,18 @@ class ExtractedImage(Base):
     is_public = Column(Boolean, default=False)  # Whether this image is available for matching
     print_design_id = Column(String)  # Reference to print design in business system
     
+    # How the page was rendered and stored (see utils.pdf_utils.render_settings); empty
+    # for pages ingested before these were recorded
+    extraction_mode = Column(String)  # "page" render or "embedded" image
+    bbox_x0 = Column(Float)  # Area of the page the image covers, in PDF points
+    bbox_y0 = Column(Float)
+    bbox_x1 = Column(Float)
+    bbox_y1 = Column(Float)
+    render_dpi = Column(Float)
+    render_alpha = Column(Boolean)
+    image_format = Column(String)  # "png", "jpeg" or "webp"
+    image_quality = Column(Integer)  # PNG compression level, JPEG/WebP quality
+    
     # Relationships
     business = relationship("Business", back_populates="extracted_images")
     dex_content = relationship("DEXContent", back_populates="image")
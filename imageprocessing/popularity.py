@@ -0,0 +1,146 @@
+"""
+Recent popularity of catalog images
+Every successful match adds a hit to the matched image and hits decay with a half-life, so
+the ranking follows whatever campaign is being scanned right now. The matcher tries the
+most popular images first and stops at the first certain hit.
+
+Each image keeps one number, the base-2 log of its decayed hit count expressed at time
+zero. All counts decay at the same rate, so the ranking never has to be recomputed as
+time passes, only when a hit is recorded. The counts are saved to features/popularity.json
+and reloaded at startup.
+
+Every server worker counts its own hits, so a save does not overwrite the file: under a file
+lock it adds the hits recorded here since the last save to the counts on disk, which hold the
+other workers' hits, writes the sum and adopts it.
+"""
+
+import heapq
+import json
+import math
+import os
+import threading
+import time
+
+try:
+    from feature_store import FEATURE_DIR, file_lock
+except ImportError:
+    from .feature_store import FEATURE_DIR, file_lock
+
+POPULARITY_PATH = os.path.join(FEATURE_DIR, "popularity.json")
+POPULARITY_HALF_LIFE = 3 * 24 * 3600  # Seconds for a hit to count half as much
+POPULARITY_TOP_N = 32  # Most popular images tried before the index search
+POPULARITY_MIN_HITS = 0.05  # Images whose decayed count falls below this are forgotten on save
+POPULARITY_SAVE_INTERVAL = 30  # Seconds between saves while hits keep coming in
+
+
+def _add_levels(a: float, b: float) -> float:
+    """log2(2**a + 2**b) without overflow"""
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1.0 + 2.0 ** (low - high))
+
+
+class PopularityTracker:
+    """Decaying per-image hit counts, persisted across restarts"""
+
+    def __init__(self, path: str = POPULARITY_PATH, half_life: float = POPULARITY_HALF_LIFE):
+        self.path = path
+        self.half_life = half_life
+        self._levels = {}  # image_id -> log2 of the decayed hit count at time zero
+        self._unsaved = {}  # Same, for the hits recorded here since the last save
+        self._discarded = set()  # Images deleted since the last save
+        self._saved_at = 0.0
+        self._lock = threading.Lock()
+        self.load()
+
+    def _age(self, now: float) -> float:
+        return now / self.half_life
+
+    def hits(self, image_id: int, now: float = None) -> float:
+        """Decayed hit count of an image"""
+        now = time.time() if now is None else now
+        level = self._levels.get(int(image_id))
+        return 0.0 if level is None else 2.0 ** (level - self._age(now))
+
+    def record_hit(self, image_id: int, now: float = None):
+        """Count a successful match of an image"""
+        now = time.time() if now is None else now
+        image_id = int(image_id)
+        with self._lock:
+            for levels in (self._levels, self._unsaved):
+                level = levels.get(image_id)
+                levels[image_id] = self._age(now) if level is None else _add_levels(level, self._age(now))
+            due = now - self._saved_at >= POPULARITY_SAVE_INTERVAL
+        if due:
+            self.save()
+
+    def top(self, n: int = POPULARITY_TOP_N) -> list:
+        """Ids of the n most popular images, most popular first"""
+        with self._lock:
+            return heapq.nlargest(n, self._levels, key=self._levels.get)
+
+    def discard(self, image_ids):
+        """Forget deleted images"""
+        with self._lock:
+            for image_id in image_ids:
+                self._levels.pop(int(image_id), None)
+                self._unsaved.pop(int(image_id), None)
+                self._discarded.add(int(image_id))
+
+    def _read(self) -> dict:
+        """Levels saved in the file, re-expressed under the current half-life"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        now = time.time()
+        shift = self._age(now) - now / data.get("half_life", self.half_life)
+        return {int(image_id): level + shift for image_id, level in data.get("levels", {}).items()}
+
+    def load(self):
+        levels = self._read()
+        with self._lock:
+            self._levels = levels
+
+    def save(self):
+        """Add this worker's new hits to the saved counts, dropping images that have gone cold"""
+        now = time.time()
+        floor = math.log2(POPULARITY_MIN_HITS) + self._age(now)
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, {}
+            discarded, self._discarded = self._discarded, set()
+            self._saved_at = now
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with file_lock(self.path + ".lock"):
+                levels = self._read()
+                for image_id, level in unsaved.items():
+                    levels[image_id] = level if image_id not in levels else _add_levels(levels[image_id], level)
+                levels = {
+                    image_id: level for image_id, level in levels.items()
+                    if level >= floor and image_id not in discarded
+                }
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"half_life": self.half_life, "levels": {str(k): v for k, v in levels.items()}}, f)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Could not save image popularity: {e}")
+            # Keep the hits for the next save
+            with self._lock:
+                for image_id, level in unsaved.items():
+                    if image_id in self._unsaved:
+                        level = _add_levels(self._unsaved[image_id], level)
+                    self._unsaved[image_id] = level
+                self._discarded |= discarded
+            return
+        with self._lock:
+            # Hits recorded while saving are not in the file yet; they stay unsaved and count here
+            for image_id, level in self._unsaved.items():
+                levels[image_id] = level if image_id not in levels else _add_levels(levels[image_id], level)
+            for image_id in self._discarded:
+                levels.pop(image_id, None)
+            self._levels = levels
+
+
+popularity = PopularityTracker()
@@ -0,0 +1,116 @@
+"""
+Match result cache for repeat scans
+Keyed by the query's 64-bit pHash together with the match scope. A lookup probes the exact
+hash and every hash one bit away, and only accepts an entry whose stored 16x16 thumbnail is
+close to the query's, so two different prints that happen to share a hash never collide.
+Entries are dropped when their matched image or its DEX content changes, and expire after
+a TTL, which also bounds staleness across server worker processes.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+QUERY_CACHE_SIZE = 1024  # Cached scans kept, least recently used evicted first
+QUERY_CACHE_TTL = 300  # Seconds an entry stays valid
+QUERY_CACHE_TOLERANCE = 4.0  # Max mean absolute 16x16 thumbnail difference for a hit, in gray levels
+
+
+def _scope_key(scope: dict, nprobe: int):
+    return (tuple(sorted(scope.items())) if scope else None, nprobe)
+
+
+class QueryCache:
+    """LRU + TTL map from query fingerprints to match responses"""
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (image_id, thumb, response, expires_at)
+        self._keys_by_image = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _drop(self, key):
+        image_id = self._entries.pop(key)[0]
+        keys = self._keys_by_image.get(image_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_image[image_id]
+
+    def get(self, query_features: dict, scope: dict = None, nprobe: int = None, is_valid=None):
+        """Return (image_id, response) cached for a matching scan, or None
+
+        is_valid(image_id) can reject entries whose image has since disappeared or changed.
+        """
+        phash = int(query_features["phash"])
+        thumb = query_features["thumb16"]
+        scope_key = _scope_key(scope, nprobe)
+        now = time.time()
+        with self._lock:
+            for flip in [0] + [1 << bit for bit in range(64)]:
+                key = (phash ^ flip, scope_key)
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                image_id, cached_thumb, response, expires_at = entry
+                if expires_at < now:
+                    self._drop(key)
+                    continue
+                if float(np.abs(cached_thumb - thumb).mean()) > QUERY_CACHE_TOLERANCE:
+                    continue
+                if is_valid is not None and not is_valid(image_id):
+                    self._drop(key)
+                    self.invalidations += 1
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image_id, response
+            self.misses += 1
+            return None
+
+    def put(self, query_features: dict, image_id: int, response: dict, scope: dict = None, nprobe: int = None):
+        """Remember the match response of a scan"""
+        key = (int(query_features["phash"]), _scope_key(scope, nprobe))
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (int(image_id), query_features["thumb16"].copy(), response, time.time() + self.ttl)
+            self._keys_by_image.setdefault(int(image_id), set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_image(self, image_id: int):
+        """Forget every cached scan that matched this image"""
+        with self._lock:
+            for key in list(self._keys_by_image.get(int(image_id), ())):
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_image.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+query_cache = QueryCache()
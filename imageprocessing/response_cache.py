@@ -0,0 +1,212 @@
+"""
+Precomputed match responses
+Every ExtractedImage's response payload (image fields plus its DEX content or the fallback
+business options) is built once and kept in memory, so a match is hydrated with a dict
+lookup instead of ORM queries. Payloads are rebuilt when the image or its DEX row changes;
+images this process has not seen yet (e.g. ingested by another worker) are loaded on first use.
+
+Every server worker keeps its own map, so each change is also appended to a shared change
+log under features/. Before serving, a worker reads whatever the log gained since its last
+look (one stat when nothing changed) and drops those payloads, to be reloaded on next use.
+"""
+
+import os
+import threading
+from sqlalchemy import and_
+
+try:
+    from models import ExtractedImage, DEXContent
+    from database import SessionLocal
+    from feature_store import FEATURE_DIR
+except ImportError:
+    from .models import ExtractedImage, DEXContent
+    from .database import SessionLocal
+    from .feature_store import FEATURE_DIR
+
+RESPONSE_CHANGES_PATH = os.path.join(FEATURE_DIR, "response_changes.log")  # One changed image id per line
+
+IMAGE_FIELDS = [
+    "image_path", "business_name", "pdf_filename", "page_number", "tags",
+    "image_type", "business_reference", "print_design_id"
+]
+
+
+def build_dex_content(dex_content, image) -> dict:
+    """DEX payload of a match, with fallback delivery options when the image has no active DEX"""
+    # Add DEX content if available with enhanced delivery options
+    if dex_content:
+        return {
+            "id": dex_content.id,
+            "title": dex_content.title,
+            "description": dex_content.description,
+            "content_type": dex_content.content_type,
+            "content_url": dex_content.content_url,
+            "content_data": dex_content.content_data,
+            "delivery_options": {
+                "ar_enabled": dex_content.content_type in ["ar", "3d_model"],
+                "video_available": dex_content.content_type == "video",
+                "webpage_available": dex_content.content_url is not None,
+                "direct_link": f"/dex/deliver/{dex_content.id}",
+                "ar_link": f"/dex/ar/{dex_content.id}" if dex_content.content_type in ["ar", "3d_model"] else None,
+                "qr_code": f"/dex/qr/{dex_content.id}"
+            }
+        }
+    # Provide fallback DEX options even without specific content
+    return {
+        "id": None,
+        "title": f"Learn more about {image.business_name}",
+        "description": f"Discover more about this {image.image_type} from {image.business_name}",
+        "content_type": "webpage",
+        "content_url": f"/business/{image.business_reference}",
+        "content_data": None,
+        "delivery_options": {
+            "ar_enabled": False,
+            "video_available": False,
+            "webpage_available": True,
+            "direct_link": f"/business/{image.business_reference}",
+            "ar_link": None,
+            "qr_code": f"/dex/qr/business/{image.business_reference}"
+        }
+    }
+
+
+def build_payload(image, dex_content) -> dict:
+    """Similarity-independent part of a match response"""
+    return {
+        "image_id": image.id,
+        "image": {name: getattr(image, name) for name in IMAGE_FIELDS},
+        "dex_content": build_dex_content(dex_content, image),
+    }
+
+
+class ResponseCache:
+    """In-memory map from image id to its precomputed response payload"""
+
+    def __init__(self, changes_path: str = RESPONSE_CHANGES_PATH):
+        self.changes_path = changes_path
+        self._payloads = {}
+        self._lock = threading.Lock()
+        self._changes_read = self._changes_size()  # Bytes of the change log already applied
+
+    def _changes_size(self) -> int:
+        try:
+            return os.stat(self.changes_path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _publish(self, image_ids):
+        """Tell every worker that these payloads changed; one append, so lines never interleave"""
+        os.makedirs(os.path.dirname(self.changes_path) or ".", exist_ok=True)
+        with open(self.changes_path, "a") as f:
+            f.write("".join(f"{image_id}\n" for image_id in image_ids))
+
+    def _sync(self):
+        """Drop the payloads that any worker changed since the last look at the change log"""
+        size = self._changes_size()
+        with self._lock:
+            if size == self._changes_read:
+                return
+            if size < self._changes_read:
+                # The log was removed or truncated: nothing is known to be current any more
+                self._payloads = {}
+                self._changes_read = 0
+                return
+            try:
+                with open(self.changes_path, "rb") as f:
+                    f.seek(self._changes_read)
+                    data = f.read(size - self._changes_read)
+            except FileNotFoundError:
+                return
+            complete = data.rfind(b"\n") + 1  # A line still being written is read next time
+            self._changes_read += complete
+            for line in data[:complete].split():
+                self._payloads.pop(int(line), None)
+
+    def _load(self, image_ids=None) -> dict:
+        """Build payloads from the database in one query: the given ids, or every image"""
+        db = SessionLocal()
+        try:
+            query = db.query(ExtractedImage, DEXContent).outerjoin(
+                DEXContent,
+                and_(DEXContent.image_id == ExtractedImage.id, DEXContent.is_active == True)
+            )
+            if image_ids is not None:
+                query = query.filter(ExtractedImage.id.in_(list(image_ids)))
+            payloads = {}
+            for image, dex_content in query.all():
+                # An image with several DEX rows keeps the first active one, like the match endpoint did
+                if image.id not in payloads or payloads[image.id]["dex_content"]["id"] is None:
+                    payloads[image.id] = build_payload(image, dex_content)
+            return payloads
+        finally:
+            db.close()
+
+    def warm(self):
+        """Precompute the payload of every image"""
+        changes_read = self._changes_size()  # Changes made while loading are applied afterwards
+        payloads = self._load()
+        with self._lock:
+            self._payloads = payloads
+            self._changes_read = changes_read
+        return len(payloads)
+
+    def refresh(self, image_ids):
+        """Rebuild the payloads of images that were created or whose DEX content changed"""
+        image_ids = {int(image_id) for image_id in image_ids}
+        if not image_ids:
+            return
+        self._publish(image_ids)
+        self._sync()
+        payloads = self._load(image_ids)
+        with self._lock:
+            for image_id in image_ids:
+                if image_id in payloads:
+                    self._payloads[image_id] = payloads[image_id]
+                else:
+                    self._payloads.pop(image_id, None)
+
+    def discard(self, image_ids):
+        """Forget deleted images"""
+        image_ids = {int(image_id) for image_id in image_ids}
+        if not image_ids:
+            return
+        self._publish(image_ids)
+        self._sync()
+
+    def is_current(self, image_id) -> bool:
+        """Whether the image's payload is held and unchanged, i.e. responses built from it still hold"""
+        self._sync()
+        with self._lock:
+            return int(image_id) in self._payloads
+
+    def get_many(self, image_ids) -> dict:
+        """Payloads of the given images that still exist, loading unknown ones once"""
+        image_ids = [int(image_id) for image_id in image_ids]
+        self._sync()
+        with self._lock:
+            found = {image_id: self._payloads[image_id] for image_id in image_ids if image_id in self._payloads}
+        unknown = set(image_ids) - set(found)
+        if unknown:
+            loaded = self._load(unknown)
+            with self._lock:
+                self._payloads.update(loaded)
+            found.update(loaded)
+        return found
+
+    def get(self, image_id: int) -> dict:
+        return self.get_many([image_id]).get(int(image_id))
+
+
+def match_response(payload: dict, similarity: float) -> dict:
+    """Full /match-image/ response body for a payload and its similarity"""
+    return {
+        "match_found": True,
+        "similarity_score": similarity,
+        "match_confidence": similarity,
+        **payload["image"],
+        "match_quality": "high" if similarity > 0.8 else "medium" if similarity > 0.6 else "low",
+        "dex_content": payload["dex_content"],
+    }
+
+
+response_cache = ResponseCache()
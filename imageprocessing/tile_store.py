@@ -0,0 +1,85 @@
+"""
+Sub-page tile descriptors
+Every catalog page is also stored as a grid of overlapping tiles (utils.image_features.tile_boxes)
+so that a photo of just a logo or one panel can be matched to its page. The tiles live in a
+second FeatureStore under features/tiles/, with the same snapshot format, compaction and scope
+attributes as the page store; a tile's id is its page id * TILE_SLOTS + its tile number.
+"""
+
+import os
+import numpy as np
+from PIL import Image
+
+try:
+    from feature_store import FeatureStore, FEATURE_DIR
+    from utils.image_features import tile_features, TILE_GRID
+except ImportError:
+    from .feature_store import FeatureStore, FEATURE_DIR
+    from .utils.image_features import tile_features, TILE_GRID
+
+TILE_DIR = os.path.join(FEATURE_DIR, "tiles/")
+TILE_SLOTS = 16  # Tile numbers reserved per page, at least TILE_GRID ** 2
+
+tile_store = FeatureStore(TILE_DIR)
+
+
+def tile_key(image_id: int, number: int) -> int:
+    return int(image_id) * TILE_SLOTS + number
+
+
+def tile_keys(image_ids) -> list:
+    """Ids of every tile of the given pages"""
+    return [tile_key(image_id, number) for image_id in image_ids for number in range(TILE_GRID ** 2)]
+
+
+def parent_ids(keys) -> np.ndarray:
+    """Page id of each tile id"""
+    return np.asarray(keys, dtype=np.int64) // TILE_SLOTS
+
+
+def add_tiles(items, store: FeatureStore = tile_store):
+    """Store the tiles of (image, tile_features) pairs, image being the page's ExtractedImage"""
+    pairs, keys = [], []
+    for image, tiles in items:
+        for number, features in enumerate(tiles):
+            pairs.append((image, features))
+            keys.append(tile_key(image.id, number))
+    store.add_many(pairs, ids=keys)
+
+
+def remove_tiles(image_ids, store: FeatureStore = tile_store):
+    """Tombstone the tiles of deleted pages"""
+    store.remove(tile_keys(image_ids))
+
+
+def backfill_tiles(db, store: FeatureStore = tile_store) -> int:
+    """Compute tiles for catalog pages that have none, then compact"""
+    try:
+        from models import ExtractedImage
+    except ImportError:
+        from .models import ExtractedImage
+
+    rows = db.query(
+        ExtractedImage.id, ExtractedImage.image_path, ExtractedImage.business_id,
+        ExtractedImage.business_reference, ExtractedImage.image_type,
+        ExtractedImage.tags, ExtractedImage.is_public
+    ).all()
+    missing = set(parent_ids(store.missing([tile_key(row.id, 0) for row in rows])).tolist())
+    tiled = [row for row in rows if row.id not in missing]
+    store.refresh_attributes(
+        [row for row in tiled for _ in range(TILE_GRID ** 2)], ids=tile_keys(row.id for row in tiled)
+    )
+
+    items = []
+    for row in rows:
+        if row.id not in missing or not os.path.exists(row.image_path):
+            continue
+        try:
+            with Image.open(row.image_path) as img:
+                items.append((row, tile_features(img)))
+        except Exception as e:
+            print(f"⚠️ Cannot backfill tiles for {row.image_path}: {e}")
+
+    add_tiles(items, store)
+    store.compact()
+    return len(items)
@@ -0,0 +1,106 @@
+"""
+Hamming-space search over 64-bit perceptual hashes
+Multi-index hashing: each hash is split into four 16-bit chunks with one lookup table per chunk.
+By the pigeonhole principle any hash within distance 4 * (r + 1) - 1 of the query shares at
+least one chunk within distance r, so probing small chunk radii finds exact nearest neighbours
+without touching the rest of the catalog.
+"""
+
+from itertools import combinations
+import numpy as np
+
+CHUNKS = 4
+CHUNK_BITS = 16
+MAX_CHUNK_RADIUS = 3  # Beyond this (distance > 15) a linear popcount scan is cheaper
+
+_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+_FLIP_MASKS = [
+    [sum(1 << bit for bit in bits) for bits in combinations(range(CHUNK_BITS), radius)]
+    for radius in range(MAX_CHUNK_RADIUS + 1)
+]
+
+
+def hamming_distances(hashes: np.ndarray, query: int) -> np.ndarray:
+    """Hamming distance from every hash in a uint64 array to the query hash"""
+    xor = np.ascontiguousarray(hashes, dtype=np.uint64) ^ np.uint64(query)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(len(xor), 8).sum(axis=1)
+
+
+def _chunks(value: int):
+    mask = (1 << CHUNK_BITS) - 1
+    return [(int(value) >> (CHUNK_BITS * i)) & mask for i in range(CHUNKS)]
+
+
+class HammingIndex:
+    """Multi-index hash table mapping 64-bit hashes to catalog rows"""
+
+    def __init__(self, hashes=None, alive=None):
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.live = np.zeros(0, dtype=bool)
+        self.tables = [{} for _ in range(CHUNKS)]
+        if hashes is not None:
+            self.add(hashes, alive)
+
+    def __len__(self):
+        return int(self.live.sum())
+
+    def add(self, hashes, alive=None):
+        """Append hashes; their rows continue from the current length. Dead rows are not indexed"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        alive = np.ones(len(hashes), dtype=bool) if alive is None else np.asarray(alive, dtype=bool)
+        start = len(self.hashes)
+        for offset, (value, is_alive) in enumerate(zip(hashes.tolist(), alive.tolist())):
+            if not is_alive:
+                continue
+            for table, chunk in zip(self.tables, _chunks(value)):
+                table.setdefault(chunk, []).append(start + offset)
+        self.hashes = np.concatenate([self.hashes, hashes])
+        self.live = np.concatenate([self.live, alive])
+
+    def remove(self, rows):
+        """Tombstone rows so they are never returned again"""
+        for row in np.asarray(rows, dtype=np.int64).tolist():
+            if not self.live[row]:
+                continue
+            for table, chunk in zip(self.tables, _chunks(int(self.hashes[row]))):
+                bucket = table[chunk]
+                bucket.remove(row)
+                if not bucket:
+                    del table[chunk]
+            self.live[row] = False
+
+    def _probe(self, query_chunks, radius, seen):
+        for table, chunk in zip(self.tables, query_chunks):
+            for flip in _FLIP_MASKS[radius]:
+                seen.update(table.get(chunk ^ flip, ()))
+
+    def search(self, query: int, k: int, allowed: np.ndarray = None):
+        """Return (rows, distances) of the k nearest hashes, closest first
+
+        allowed is an optional boolean mask over rows; rows outside it are never returned.
+        """
+        searchable = self.live if allowed is None else self.live & allowed[:len(self.live)]
+        k = min(k, int(searchable.sum()))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        query_chunks = _chunks(query)
+        seen = set()
+        for radius in range(MAX_CHUNK_RADIUS + 1):
+            self._probe(query_chunks, radius, seen)
+            rows = np.fromiter(seen, dtype=np.int64, count=len(seen))
+            if allowed is not None:
+                rows = rows[allowed[rows]]
+            distances = hamming_distances(self.hashes[rows], query)
+            # Everything within this bound is guaranteed to have been probed
+            guaranteed = distances <= CHUNKS * (radius + 1) - 1
+            if guaranteed.sum() >= k:
+                order = np.argsort(distances, kind='stable')[:k]
+                return rows[order], distances[order]
+
+        # Too few close neighbours, fall back to a vectorized scan of every searchable hash
+        distances = hamming_distances(self.hashes, query)
+        distances[~searchable] = 65  # Farther than any real distance
+        rows = np.argpartition(distances, k - 1)[:k]
+        order = np.argsort(distances[rows], kind='stable')
+        return rows[order], distances[rows[order]]
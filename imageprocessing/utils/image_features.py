@@ -0,0 +1,314 @@
+"""
+Image feature extraction for the matcher
+Computes the descriptors used by the similarity metrics so they can be stored once at ingest
+"""
+
+import io
+import numpy as np
+from PIL import Image, ImageOps
+
+FEATURE_VERSION = 1  # Bump whenever extraction changes; stored snapshots from other versions get rebuilt
+FEATURE_SIZE = (64, 64)  # Resolution the similarity metrics work at
+HIST_BINS = 32
+
+PHASH_INPUT = 32  # pHash works on a 32x32 downsample of the 64x64 descriptor
+PHASH_SIZE = 8  # Low-frequency 8x8 DCT block -> 64-bit hash
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II basis, so pHash needs no scipy"""
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    basis = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    basis[0] /= np.sqrt(2)
+    return basis.astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_INPUT)[:PHASH_SIZE]
+
+
+def perceptual_hashes(gray: np.ndarray) -> np.ndarray:
+    """Compute 64-bit pHashes for an (N, 64, 64) stack of grayscale descriptors"""
+    count = len(gray)
+    factor = FEATURE_SIZE[0] // PHASH_INPUT
+    small = gray.reshape(count, PHASH_INPUT, factor, PHASH_INPUT, factor).astype(np.float32).mean(axis=(2, 4))
+    block = np.einsum('ij,njk,lk->nil', _DCT, small, _DCT).reshape(count, -1)
+    # Compare against the median of the AC terms; the DC term only tracks brightness
+    bits = block > np.median(block[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+DESCRIPTOR_THUMB = 16  # Side of the grayscale thumbnail in the IVF descriptor
+DESCRIPTOR_GRID = 4  # Edge energy is pooled over a 4x4 grid
+# Block weights mirror the score: pixel terms 0.6, histogram 0.2, edges 0.2
+DESCRIPTOR_WEIGHTS = (0.6, 0.2, 0.2)
+DESCRIPTOR_DIM = DESCRIPTOR_THUMB ** 2 + HIST_BINS + DESCRIPTOR_GRID ** 2
+
+
+def _l2_normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-6)
+
+
+def descriptor_vectors(gray: np.ndarray, hist: np.ndarray, grad: np.ndarray) -> np.ndarray:
+    """Fixed-length vectors for the IVF index: thumbnail + histogram + edge energy
+
+    Each block is L2-normalized and scaled by the square root of its weight, so the squared
+    Euclidean distance is a weighted sum of the per-block distances.
+    """
+    count = len(gray)
+    thumb_factor = FEATURE_SIZE[0] // DESCRIPTOR_THUMB
+    thumb = gray.reshape(count, DESCRIPTOR_THUMB, thumb_factor, DESCRIPTOR_THUMB, thumb_factor)
+    thumb = thumb.astype(np.float32).mean(axis=(2, 4)).reshape(count, -1)
+    thumb = _l2_normalize(thumb - thumb.mean(axis=1, keepdims=True))
+
+    # Hellinger embedding: sqrt of a normalized histogram already has unit norm
+    hist_block = np.sqrt(hist.astype(np.float32))
+
+    grid_factor = FEATURE_SIZE[0] // DESCRIPTOR_GRID
+    magnitude = np.abs(grad.astype(np.float32)).sum(axis=1)
+    energy = magnitude.reshape(count, DESCRIPTOR_GRID, grid_factor, DESCRIPTOR_GRID, grid_factor).mean(axis=(2, 4))
+    energy = _l2_normalize(energy.reshape(count, -1))
+
+    weights = np.sqrt(np.array(DESCRIPTOR_WEIGHTS, dtype=np.float32))
+    return np.concatenate([thumb * weights[0], hist_block * weights[1], energy * weights[2]], axis=1)
+
+
+CASCADE_THUMBS = (8, 16)  # Block-mean thumbnails the matcher's cascade bounds the pixel terms with
+STATS_DIM = 4  # Grayscale mean and variance, mean |grad_y| and mean |grad_x|
+
+
+def coarse_descriptors(gray: np.ndarray, grad: np.ndarray) -> dict:
+    """Cheap summaries of (N, 64, 64) descriptors that upper-bound the full similarity score
+
+    The thumbnails are exact block means of the stored grayscale, so their MSE never exceeds
+    the full-resolution MSE; the stats are taken from the stored (float16) gradients.
+    """
+    count = len(gray)
+    pixels = gray.reshape(count, -1).astype(np.float64)
+    coarse = {}
+    for side in CASCADE_THUMBS:
+        factor = FEATURE_SIZE[0] // side
+        thumb = gray.reshape(count, side, factor, side, factor).astype(np.float64).mean(axis=(2, 4))
+        coarse[f"thumb{side}"] = thumb.astype(np.float32)
+    coarse["stats"] = np.stack([
+        pixels.mean(axis=1),
+        pixels.var(axis=1),
+        *np.abs(grad.astype(np.float32)).mean(axis=(2, 3)).T,
+    ], axis=1).astype(np.float32)
+    return coarse
+
+
+def extract_features(img: Image.Image) -> dict:
+    """Compute the grayscale, pHash, histogram, gradient, IVF vector and cascade descriptors for an image"""
+    # Same order as the matcher always used: resize first, then grayscale
+    gray = np.array(img.resize(FEATURE_SIZE).convert('L'))
+
+    hist, _ = np.histogram(gray, bins=HIST_BINS, range=(0, 256))
+    hist = hist / np.sum(hist)
+
+    # Gradients of a uint8 image are multiples of 0.5 in [-255, 255], exact in float16
+    grad_y, grad_x = np.gradient(gray)
+
+    gray = gray.astype(np.uint8)
+    hist = hist.astype(np.float32)
+    grad = np.stack([grad_y, grad_x]).astype(np.float16)
+    features = {
+        "gray": gray,
+        "phash": perceptual_hashes(gray[None])[0],
+        "hist": hist,
+        "grad": grad,
+        "vector": descriptor_vectors(gray[None], hist[None], grad[None])[0]
+    }
+    features.update({name: value[0] for name, value in coarse_descriptors(gray[None], grad[None]).items()})
+    return features
+
+
+TILE_GRID = 3  # Tiles per side of a page
+TILE_SPAN = 0.5  # Each tile covers half the page width and height, so neighbours overlap by half
+
+
+def tile_boxes(width: int, height: int) -> list:
+    """Crop boxes of the overlapping sub-page tiles, row by row"""
+    step = (1 - TILE_SPAN) / (TILE_GRID - 1)
+    return [
+        (round(col * step * width), round(row * step * height),
+         round((col * step + TILE_SPAN) * width), round((row * step + TILE_SPAN) * height))
+        for row in range(TILE_GRID)
+        for col in range(TILE_GRID)
+    ]
+
+
+def tile_features(img: Image.Image) -> list:
+    """extract_features() of every tile of a page, so a photo of one panel or logo can match"""
+    return [extract_features(img.crop(box)) for box in tile_boxes(*img.size)]
+
+
+MAX_QUERY_BYTES = 25 * 1024 * 1024  # Largest uploaded frame accepted for matching
+MAX_QUERY_PIXELS = 64_000_000  # Checked from the header, before anything is decoded
+QUERY_DRAFT_SIZE = 4 * FEATURE_SIZE[0]  # JPEGs are DCT-scaled down to no less than this per side
+
+
+def decode_query_image(data: bytes) -> Image.Image:
+    """Decode an uploaded camera frame at reduced resolution, upright, for extract_features
+
+    JPEGs are decoded straight to grayscale at 1/2-1/8 scale; other formats decode normally.
+    Raises ValueError when the frame exceeds the byte or pixel limits.
+    """
+    if len(data) > MAX_QUERY_BYTES:
+        raise ValueError(f"Image is larger than {MAX_QUERY_BYTES // (1024 * 1024)} MB")
+    img = Image.open(io.BytesIO(data))
+    if img.width * img.height > MAX_QUERY_PIXELS:
+        raise ValueError(f"Image has more than {MAX_QUERY_PIXELS // 1_000_000} megapixels")
+    img.draft('L', (QUERY_DRAFT_SIZE, QUERY_DRAFT_SIZE))
+    return ImageOps.exif_transpose(img)
+
+
+QUALITY_SIZE = 256  # Frames are judged at this longest side, about what the draft decode yields
+# Darkest and brightest levels, ignoring specks and specular glints; the dark end is low enough
+# that the small print of a mostly white page still counts
+QUALITY_PERCENTILES = (0.05, 99.5)
+MAX_DARK_LEVEL = 40  # Brightest level below this: underexposed, nothing but shadow
+MIN_TONAL_RANGE = 48  # Fewer gray levels than this between darkest and brightest: nothing to match...
+MIN_BRIGHT_LEVEL = 205  # ...washed out by glare or overexposure if the mean level is above this, else a blank wall
+MIN_SHARPNESS = 0.01  # Laplacian variance over gray-level variance below this: out of focus or shaken
+
+QUALITY_MESSAGES = {
+    "too_dark": "The photo is too dark. Add light or move out of the shadow and try again.",
+    "overexposed": "The photo is washed out. Avoid glare and direct light and try again.",
+    "uniform": "There is nothing to match in the photo. Point the camera at the print and try again.",
+    "blurry": "The photo is blurry. Hold the camera steady, let it focus and try again.",
+}
+
+
+class FrameQualityError(ValueError):
+    """A query frame not worth scanning; reason is a key of QUALITY_MESSAGES"""
+
+    def __init__(self, reason: str, metrics: dict):
+        # Both go to the base class so the error survives pickling out of a worker process
+        super().__init__(reason, metrics)
+        self.reason = reason
+        self.metrics = metrics
+
+    def __str__(self):
+        return QUALITY_MESSAGES[self.reason]
+
+
+def frame_quality(img: Image.Image) -> dict:
+    """Exposure, tonal range and sharpness of a frame, measured on a small grayscale copy"""
+    gray = img.convert('L')
+    gray.thumbnail((QUALITY_SIZE, QUALITY_SIZE))
+    gray = np.asarray(gray, dtype=np.float32)
+    dark, bright = np.percentile(gray, QUALITY_PERCENTILES)
+    laplacian = (
+        gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1] - 4 * gray[1:-1, 1:-1]
+    )
+    # Normalized by the contrast, so a dim but sharp frame is not mistaken for a blurry one
+    sharpness = float(laplacian.var()) / max(float(gray.var()), 1.0)
+    return {
+        "dark_level": float(dark), "bright_level": float(bright), "mean_level": float(gray.mean()),
+        "sharpness": sharpness
+    }
+
+
+def check_frame_quality(img: Image.Image) -> dict:
+    """Return the frame_quality() metrics, or raise FrameQualityError for an unusable frame"""
+    metrics = frame_quality(img)
+    if metrics["bright_level"] < MAX_DARK_LEVEL:
+        raise FrameQualityError("too_dark", metrics)
+    if metrics["bright_level"] - metrics["dark_level"] < MIN_TONAL_RANGE:
+        raise FrameQualityError("overexposed" if metrics["mean_level"] > MIN_BRIGHT_LEVEL else "uniform", metrics)
+    if metrics["sharpness"] < MIN_SHARPNESS:
+        raise FrameQualityError("blurry", metrics)
+    return metrics
+
+
+PAGE_BORDER = 0.04  # Ring around the frame taken as backdrop, as a share of the shorter side
+MIN_BACKDROP_SHARE = 0.7  # Share of that ring that must be darker than the paper
+MIN_BACKDROP_NOISE = 0.75  # Gray-level spread of a real backdrop; flat digital borders are left alone
+PAGE_PROJECTION_LEVEL = 0.5  # Rows and columns at least this share as paper-filled as the fullest
+PAGE_AREA_RANGE = (0.15, 0.92)  # Page boxes outside this share of the frame are not cropped
+MIN_PAGE_FILL = 0.6  # Share of the page box that must be paper
+
+
+def _otsu_threshold(gray: np.ndarray) -> float:
+    """Gray level that best splits the frame into two classes"""
+    hist = np.bincount(gray.astype(np.uint8).ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight = np.cumsum(hist)
+    total = weight[-1]
+    cumulative = np.cumsum(hist * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_low = cumulative / weight
+        mean_high = (cumulative[-1] - cumulative) / (total - weight)
+        between = weight * (total - weight) * (mean_low - mean_high) ** 2
+    return float(np.argmax(np.nan_to_num(between)))
+
+
+def locate_page(img: Image.Image):
+    """Corners of a printed page photographed against a darker backdrop, or None
+
+    Works on a small grayscale copy: the paper is the bright class of an Otsu split, its
+    box comes from the row and column projections of that mask, and the corners are the
+    paper pixels furthest along the two diagonals. Returns [top-left, top-right,
+    bottom-right, bottom-left] in image pixels. Frames that are already just the page,
+    such as uploaded renders, have no darker, noisy backdrop and return None.
+    """
+    small = img.convert('L')
+    small.thumbnail((QUALITY_SIZE, QUALITY_SIZE))
+    gray = np.asarray(small, dtype=np.float32)
+    height, width = gray.shape
+    paper = gray > _otsu_threshold(gray)
+
+    border = max(1, round(PAGE_BORDER * min(height, width)))
+    ring = np.ones_like(paper)
+    ring[border:-border, border:-border] = False
+    if paper[ring].mean() > 1 - MIN_BACKDROP_SHARE or gray[ring & ~paper].std() < MIN_BACKDROP_NOISE:
+        return None
+
+    cols = paper.mean(axis=0)
+    rows = paper.mean(axis=1)
+    xs = np.flatnonzero(cols >= PAGE_PROJECTION_LEVEL * cols.max())
+    ys = np.flatnonzero(rows >= PAGE_PROJECTION_LEVEL * rows.max())
+    x0, x1, y0, y1 = xs[0], xs[-1] + 1, ys[0], ys[-1] + 1
+    area = (x1 - x0) * (y1 - y0) / (width * height)
+    if not PAGE_AREA_RANGE[0] <= area <= PAGE_AREA_RANGE[1] or paper[y0:y1, x0:x1].mean() < MIN_PAGE_FILL:
+        return None
+
+    py, px = np.nonzero(paper[y0:y1, x0:x1])
+    px = px + x0 + 0.5
+    py = py + y0 + 0.5
+    diagonal, anti_diagonal = px + py, px - py
+    corners = [np.argmin(diagonal), np.argmax(anti_diagonal), np.argmax(diagonal), np.argmin(anti_diagonal)]
+    scale_x, scale_y = img.width / width, img.height / height
+    return [(float(px[i] * scale_x), float(py[i] * scale_y)) for i in corners]
+
+
+def crop_to_page(img: Image.Image) -> Image.Image:
+    """Cut the printed page out of a camera frame and square it up; other frames pass through"""
+    corners = locate_page(img)
+    if corners is None:
+        return img
+    top_left, top_right, bottom_right, bottom_left = np.array(corners)
+    size = (
+        max(1, round((np.linalg.norm(top_right - top_left) + np.linalg.norm(bottom_right - bottom_left)) / 2)),
+        max(1, round((np.linalg.norm(bottom_left - top_left) + np.linalg.norm(bottom_right - top_right)) / 2)),
+    )
+    # QUAD maps the source corners in upper-left, lower-left, lower-right, upper-right order
+    quad = [*top_left, *bottom_left, *bottom_right, *top_right]
+    return img.transform(size, Image.QUAD, quad, resample=Image.BILINEAR)
+
+
+def pixmap_array(pix) -> np.ndarray:
+    """(height, width, channels) uint8 view of a PyMuPDF pixmap's samples, without a copy"""
+    rows = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)
+    return rows[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+
+
+def pixmap_to_image(pix) -> Image.Image:
+    """Wrap a PyMuPDF pixmap as a PIL image without a PNG round trip
+
+    The pixmap must outlive the image when it is RGBA, whose pixels are shared, not copied.
+    """
+    samples = pixmap_array(pix)
+    return Image.fromarray(samples if pix.n > 1 else samples[..., 0])
@@ -0,0 +1,142 @@
+"""
+Inverted-file (IVF) index over catalog descriptor vectors
+k-means coarse centroids with one posting list per cell; a query only visits the nprobe
+cells whose centroids are closest. Pure NumPy, no faiss dependency.
+"""
+
+import numpy as np
+
+IVF_MIN_TRAIN = 256  # Below this many images a full scan is cheaper than clustering
+IVF_NPROBE = 4  # Cells probed per query; raise for recall, lower for latency
+IVF_MAX_NPROBE = 256  # Most cells a request may ask to probe
+IVF_KMEANS_ITERS = 16
+IVF_TRAIN_SAMPLE = 64  # Training points per centroid, enough for stable cells
+RETRAIN_GROWTH = 2.0  # Re-cluster once the index has grown this much since training
+ASSIGN_CHUNK = 4096
+
+
+def _squared_distances(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return (
+        np.einsum('ij,ij->i', x, x)[:, None]
+        - 2 * x @ centroids.T
+        + np.einsum('ij,ij->i', centroids, centroids)[None, :]
+    )
+
+
+def assign(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the nearest centroid for each row, in bounded-memory chunks"""
+    labels = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), ASSIGN_CHUNK):
+        labels[start:start + ASSIGN_CHUNK] = np.argmin(_squared_distances(x[start:start + ASSIGN_CHUNK], centroids), axis=1)
+    return labels
+
+
+def kmeans(x: np.ndarray, k: int, iters: int = IVF_KMEANS_ITERS, seed: int = 0) -> np.ndarray:
+    """Lloyd's k-means, returns (k, dim) centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        labels = assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty cells with random points so every cell stays useful
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), size=len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """Coarse-quantized posting lists mapping cells to catalog rows"""
+
+    def __init__(self, nprobe: int = IVF_NPROBE):
+        self.nprobe = nprobe
+        self.centroids = None
+        self.lists = []
+        self.labels = np.zeros(0, dtype=np.int64)  # Cell of each row, -1 if not indexed
+        self.size = 0
+        self.trained_size = 0
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def live_size(self) -> int:
+        return int((self.labels >= 0).sum()) if self.trained else self.size
+
+    def needs_retrain(self) -> bool:
+        """True once the catalog has grown enough that the cells are too coarse"""
+        if not self.trained:
+            return self.live_size >= IVF_MIN_TRAIN
+        return self.live_size >= self.trained_size * RETRAIN_GROWTH
+
+    def train(self, vectors: np.ndarray, alive: np.ndarray = None):
+        """(Re)cluster the live vectors and rebuild the posting lists from scratch"""
+        alive = np.ones(len(vectors), dtype=bool) if alive is None else np.asarray(alive, dtype=bool)
+        live_rows = np.flatnonzero(alive)
+        self.size = 0
+        self.labels = np.zeros(0, dtype=np.int64)
+        if len(live_rows) < IVF_MIN_TRAIN:
+            self.centroids = None
+            self.lists = []
+            self.size = len(vectors)
+            return
+        n_lists = int(np.sqrt(len(live_rows)))
+        rng = np.random.default_rng(0)
+        sample_size = min(len(live_rows), n_lists * IVF_TRAIN_SAMPLE)
+        sample = vectors[np.sort(rng.choice(live_rows, size=sample_size, replace=False))]
+        self.centroids = kmeans(sample, n_lists)
+        self.lists = [[] for _ in range(n_lists)]
+        self.add(vectors, alive)
+        self.trained_size = len(live_rows)
+
+    def add(self, vectors: np.ndarray, alive: np.ndarray = None):
+        """Append vectors; their rows continue from the current size. Dead rows are not indexed"""
+        start = self.size
+        self.size += len(vectors)
+        if not self.trained:
+            return
+        labels = assign(vectors, self.centroids) if len(vectors) else np.zeros(0, dtype=np.int64)
+        if alive is not None:
+            labels[~np.asarray(alive, dtype=bool)] = -1
+        for offset, label in enumerate(labels.tolist()):
+            if label >= 0:
+                self.lists[label].append(start + offset)
+        self.labels = np.concatenate([self.labels, labels])
+
+    def remove(self, rows):
+        """Tombstone rows so they are never probed again"""
+        if not self.trained:
+            return
+        for row in np.asarray(rows, dtype=np.int64).tolist():
+            label = int(self.labels[row])
+            if label >= 0:
+                self.lists[label].remove(row)
+                self.labels[row] = -1
+
+    def remap(self, mapping: np.ndarray, size: int):
+        """Renumber rows after compaction without re-clustering
+
+        mapping[old_row] is the new row, or -1 if the row is gone; size is the new row count.
+        """
+        mapping = np.asarray(mapping, dtype=np.int64)
+        if self.trained:
+            kept = np.flatnonzero(mapping >= 0)
+            labels = np.full(size, -1, dtype=np.int64)
+            labels[mapping[kept]] = self.labels[kept]
+            self.labels = labels
+            self.lists = [mapping[np.array(cell, dtype=np.int64)].tolist() for cell in self.lists]
+            self.lists = [[row for row in cell if row >= 0] for cell in self.lists]
+        self.size = size
+
+    def search(self, query: np.ndarray, nprobe: int = None, allowed: np.ndarray = None) -> np.ndarray:
+        """Rows in the nprobe cells closest to the query vector, restricted to an optional row mask"""
+        nprobe = max(1, min(nprobe or self.nprobe, IVF_MAX_NPROBE, len(self.lists)))
+        distances = _squared_distances(query[None, :], self.centroids)[0]
+        cells = np.argpartition(distances, nprobe - 1)[:nprobe]
+        rows = np.array([row for cell in cells for row in self.lists[cell]], dtype=np.int64)
+        return rows if allowed is None else rows[allowed[rows]]
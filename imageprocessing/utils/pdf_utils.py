@@ -1,19 +1,310 @@
 import fitz  # PyMuPDF
+import hashlib
+import io
+import multiprocessing
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-def extract_images_from_pdf(pdf_path, output_dir):
-    doc = fitz.open(pdf_path)
+from PIL import Image
+
+try:
+    from utils.image_features import extract_features, tile_features, pixmap_to_image, FEATURE_SIZE, QUERY_DRAFT_SIZE
+except ImportError:
+    from .image_features import extract_features, tile_features, pixmap_to_image, FEATURE_SIZE, QUERY_DRAFT_SIZE
+
+RENDER_WORKERS = max(1, os.cpu_count() or 1)
+PARALLEL_MIN_PAGES = 8  # Shorter documents render in-process; a pool costs more than it saves
+RENDER_CHUNK_PAGES = 4  # Pages rendered per pool task, sharing one opened document
+RENDER_IN_FLIGHT = 2  # Chunks queued per worker; bounds the rendered pages held in memory
+THUMBNAIL_SIZE = QUERY_DRAFT_SIZE  # Longest side of the small render: gallery thumbnail and matching input
+MIN_MATCH_SIDE = 2 * FEATURE_SIZE[0]  # Shortest side of the small render, so half-page tiles still downscale
+THUMBNAIL_QUALITY = 85
+
+PDF_DPI = 72  # PDF user space units per inch; rendering at this DPI is scale 1
+DEFAULT_RENDER_DPI = 72
+MAX_RENDER_DPI = 600
+# Output codecs of the archived page image: file extension, quality range (PNG: zlib
+# compression level; JPEG and WebP: lossy quality) with its default, and whether it can
+# store transparency, which is also whether pages keep it by default
+IMAGE_FORMATS = {
+    "png": {"extension": "png", "quality": (0, 9), "default_quality": 6, "alpha": True},
+    "jpeg": {"extension": "jpg", "quality": (1, 95), "default_quality": 90, "alpha": False},
+    "webp": {"extension": "webp", "quality": (1, 100), "default_quality": 90, "alpha": True},
+}
+
+# What an ingest extracts: rendered pages, the raster images embedded in them, or both
+EXTRACTION_MODES = ("pages", "embedded", "both")
+MIN_EMBEDDED_SIDE = FEATURE_SIZE[0]  # Embedded images narrower or shorter than this (pixels) are skipped
+MIN_EMBEDDED_SHARE = 0.02  # ...as are those placed over less than this share of the page: icons, badges
+
+
+def render_settings(dpi=None, max_dimension=None, alpha=None, image_format="png", quality=None, mode="pages"):
+    """Validated per-ingest render settings for extract_images_from_pdf
+
+    dpi is the render resolution (default 72); max_dimension, if given, caps the longest side
+    of every page in pixels, lowering its DPI. alpha keeps page transparency in the stored
+    render, by default whenever the format can store it; without it pages are rendered onto
+    white, as thumbnails and descriptors always are. mode is one of EXTRACTION_MODES; embedded images keep their own
+    resolution and codec. Raises ValueError for settings that cannot be honoured.
+    """
+    if mode not in EXTRACTION_MODES:
+        raise ValueError(f"Unsupported extraction mode '{mode}', use one of {', '.join(EXTRACTION_MODES)}")
+    image_format = (image_format or "png").lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format '{image_format}', use one of {', '.join(IMAGE_FORMATS)}")
+    dpi = DEFAULT_RENDER_DPI if dpi is None else float(dpi)
+    if not 0 < dpi <= MAX_RENDER_DPI:
+        raise ValueError(f"DPI must be between 0 and {MAX_RENDER_DPI}")
+    if max_dimension is not None and int(max_dimension) < THUMBNAIL_SIZE:
+        raise ValueError(f"Max dimension must be at least {THUMBNAIL_SIZE} pixels")
+    if alpha is None:
+        alpha = IMAGE_FORMATS[image_format]["alpha"]
+    elif alpha and not IMAGE_FORMATS[image_format]["alpha"]:
+        raise ValueError(f"{image_format.upper()} cannot store transparency, render without alpha")
+    low, high = IMAGE_FORMATS[image_format]["quality"]
+    quality = IMAGE_FORMATS[image_format]["default_quality"] if quality is None else int(quality)
+    if not low <= quality <= high:
+        raise ValueError(f"{image_format.upper()} quality must be between {low} and {high}")
+    return {
+        "dpi": dpi,
+        "max_dimension": None if max_dimension is None else int(max_dimension),
+        "alpha": bool(alpha),
+        "image_format": image_format,
+        "quality": quality,
+        "mode": mode,
+    }
+
+
+def thumbnail_path(image_path):
+    """Where the gallery thumbnail of an extracted page image is written"""
+    return f"{os.path.splitext(image_path)[0]}_thumb.jpg"
+
+
+def _render_scale(rect, settings):
+    """Scale of the full render: the requested DPI, lowered to fit max_dimension"""
+    scale = settings["dpi"] / PDF_DPI
+    if settings["max_dimension"]:
+        scale = min(scale, settings["max_dimension"] / max(rect.width, rect.height))
+    return scale
+
+
+def _small_render_matrix(rect, full_scale):
+    """Scale matrix rendering a page at thumbnail size, never above the full render"""
+    scale = max(THUMBNAIL_SIZE / max(rect.width, rect.height), MIN_MATCH_SIDE / max(1, min(rect.width, rect.height)))
+    scale = min(full_scale, scale)
+    return fitz.Matrix(scale, scale)
+
+
+def _save_image(image, path, settings):
+    if settings["image_format"] == "png":
+        image.save(path, "PNG", compress_level=settings["quality"])
+    else:
+        image.save(path, settings["image_format"].upper(), quality=settings["quality"])
+
+
+def _render_page(doc, page_number, pdf_path, output_dir, settings):
+    """Render one page to an image file and compute its thumbnail and matching descriptors
+
+    The page is interpreted once into a display list. The full render is encoded straight
+    from its pixmap; the descriptors, tiles and thumbnail all come from a second, small render
+    of the same display list, so the full raster is never decoded or downscaled in Python.
+    """
+    page = doc[page_number]
+    display_list = page.get_displaylist()
+    scale = _render_scale(page.rect, settings)
+    # Render the entire page as an image (full page snapshot)
+    pix = display_list.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=settings["alpha"])
+    extension = IMAGE_FORMATS[settings["image_format"]]["extension"]
+    image_filename = f"{os.path.splitext(os.path.basename(pdf_path))[0]}_page{page_number+1}.{extension}"
+    image_path = os.path.join(output_dir, image_filename)
+    _save_image(pixmap_to_image(pix), image_path, settings)
+    del pix
+
+    # Without alpha: unpainted areas are white on paper, so thumbnail and descriptors see them white
+    small = display_list.get_pixmap(matrix=_small_render_matrix(page.rect, scale), alpha=False)
+    image = pixmap_to_image(small)
+    image.save(thumbnail_path(image_path), quality=THUMBNAIL_QUALITY)
+    return {
+        "image_path": image_path,
+        "thumbnail_path": thumbnail_path(image_path),
+        "page_number": page_number + 1,
+        # Matching descriptors (grayscale, pHash, ...), computed from the small render
+        "features": extract_features(image),
+        "tiles": tile_features(image),
+        # How the page was rendered and stored, keyed by ExtractedImage column
+        "render": {
+            "extraction_mode": "page",
+            **_bbox_columns(page.rect),
+            "render_dpi": round(scale * PDF_DPI, 2),
+            "render_alpha": settings["alpha"],
+            "image_format": settings["image_format"],
+            "image_quality": settings["quality"],
+        }
+    }
+
+
+def _bbox_columns(rect):
+    return {"bbox_x0": rect.x0, "bbox_y0": rect.y0, "bbox_x1": rect.x1, "bbox_y1": rect.y1}
+
+
+def _embedded_pixmap(doc, xref, smask):
+    """Decoded pixels of an image XObject, as RGB, with its soft mask as alpha"""
+    pix = fitz.Pixmap(doc, xref)
+    if pix.colorspace is None or pix.colorspace.n != 3:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if smask and not pix.alpha:
+        mask = fitz.Pixmap(doc, smask)
+        if mask.width == pix.width and mask.height == pix.height:
+            pix = fitz.Pixmap(pix, mask)
+    return pix
+
+
+def _jpeg_stream(doc, xref, smask):
+    """The XObject's stream when it is a browser-viewable JPEG file as it stands, else None"""
+    if smask or doc.xref_get_key(xref, "Filter") != ("name", "/DCTDecode"):
+        return None
+    raw = doc.extract_image(xref)  # DCT streams are handed back as they are, not re-encoded
+    return raw["image"] if raw["colorspace"] in (1, 3) else None
+
+
+def _embedded_image(doc, xref, smask, jpeg, settings):
+    """Decode an embedded image at matching size, along with the full image to store (or None)"""
+    if jpeg is not None:
+        image = Image.open(io.BytesIO(jpeg))
+        image.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))  # DCT-scaled decode
+        return image.convert("RGB"), None
+    pix = _embedded_pixmap(doc, xref, smask)
+    image = pixmap_to_image(pix)
+    if image.mode == "RGBA":
+        image = image.copy()  # RGBA shares the pixmap's pixels, which are freed on return
+        # Transparent parts are seen on paper, so match them as white
+        flat = Image.alpha_composite(Image.new("RGBA", image.size, (255, 255, 255, 255)), image).convert("RGB")
+        return flat, image if settings["alpha"] else flat
+    return image, image
+
+
+def extract_embedded_images(pdf_path, output_dir, settings=None):
+    """Pull the raster images embedded in a PDF, without rendering anything
+
+    Each image XObject is kept once, however often it is placed and under whichever xref.
+    Images below MIN_EMBEDDED_SIDE pixels or placed over less than MIN_EMBEDDED_SHARE of
+    their page are skipped before anything is decoded. JPEG streams are written byte for byte
+    and decoded at reduced size; other images are decoded once and stored with the format,
+    quality and alpha of settings. Info dicts are those of extract_images_from_pdf, the
+    bounding box being the image's placement on the page in PDF points.
+    """
+    settings = settings or render_settings()
     images_info = []
+    seen_xrefs, seen_digests = set(), set()
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            for item in page.get_images(full=True):
+                xref, smask, width, height = item[0], item[1], item[2], item[3]
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+                if min(width, height) < MIN_EMBEDDED_SIDE:
+                    continue
+                bbox = page.get_image_bbox(item)
+                if bbox.is_infinite or bbox.is_empty:
+                    bbox = page.rect  # Placed through a form XObject; its own box is not known
+                if abs(bbox & page.rect) < MIN_EMBEDDED_SHARE * abs(page.rect):
+                    continue
+                # Identical streams under different xrefs: compare the still-compressed bytes
+                digest = hashlib.sha1(doc.xref_stream_raw(xref) + str(smask).encode()).hexdigest()
+                if digest in seen_digests:
+                    continue
+                seen_digests.add(digest)
 
-    for page_number in range(len(doc)):
-        page = doc[page_number]
-        # Render the entire page as an image (full page snapshot)
-        pix = page.get_pixmap(alpha=True)  # alpha=True for transparency if present
-        image_filename = f"{os.path.splitext(os.path.basename(pdf_path))[0]}_page{page_number+1}.png"
-        image_path = os.path.join(output_dir, image_filename)
-        pix.save(image_path)
-        images_info.append({
-            "image_path": image_path,
-            "page_number": page_number + 1
-        })
-    return images_info 
\ No newline at end of file
+                try:
+                    jpeg = _jpeg_stream(doc, xref, smask)
+                    image, archive = _embedded_image(doc, xref, smask, jpeg, settings)
+                except Exception as e:
+                    print(f"⚠️ Cannot decode embedded image {xref} on page {page.number + 1}: {e}")
+                    continue
+
+                image_format = "jpeg" if jpeg is not None else settings["image_format"]
+                extension = IMAGE_FORMATS[image_format]["extension"]
+                image_path = os.path.join(output_dir, f"{stem}_page{page.number + 1}_img{xref}.{extension}")
+                if jpeg is not None:
+                    with open(image_path, "wb") as f:
+                        f.write(jpeg)
+                else:
+                    _save_image(archive, image_path, settings)
+
+                scale = min(1.0, max(THUMBNAIL_SIZE / max(image.size), MIN_MATCH_SIDE / min(image.size)))
+                small = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BOX)
+                small.save(thumbnail_path(image_path), quality=THUMBNAIL_QUALITY)
+                images_info.append({
+                    "image_path": image_path,
+                    "thumbnail_path": thumbnail_path(image_path),
+                    "page_number": page.number + 1,
+                    "features": extract_features(small),
+                    "tiles": tile_features(small),
+                    "render": {
+                        "extraction_mode": "embedded",
+                        **_bbox_columns(bbox),
+                        # Effective resolution of the image where it is placed
+                        "render_dpi": round(width / max(bbox.width, 1e-6) * PDF_DPI, 2),
+                        "render_alpha": archive is not None and archive.mode == "RGBA",
+                        "image_format": image_format,
+                        "image_quality": None if jpeg is not None else settings["quality"],
+                    }
+                })
+    print(f"🖼️ Extracted {len(images_info)} embedded image(s) from {os.path.basename(pdf_path)}")
+    return images_info
+
+
+def _render_pages(pdf_path, output_dir, page_numbers, settings):
+    """Pool task: open the document in this worker and render a run of pages"""
+    with fitz.open(pdf_path) as doc:
+        return [_render_page(doc, page_number, pdf_path, output_dir, settings) for page_number in page_numbers]
+
+
+def extract_images_from_pdf(pdf_path, output_dir, workers=None, settings=None):
+    """Render every page of a PDF, returning one info dict per page in page order
+
+    settings come from render_settings() and default to 72 DPI RGBA PNG pages. In "embedded"
+    mode the embedded images are returned instead (extract_embedded_images), in "both" mode
+    after the pages. Documents of PARALLEL_MIN_PAGES or more are split into runs of pages
+    rendered by a process pool of `workers` (default RENDER_WORKERS; 1 renders in-process),
+    each worker opening its own copy of the document. At most RENDER_IN_FLIGHT runs per worker
+    are outstanding at a time.
+    """
+    settings = settings or render_settings()
+    if settings["mode"] == "embedded":
+        return extract_embedded_images(pdf_path, output_dir, settings)
+    if settings["mode"] == "both":
+        return (
+            extract_images_from_pdf(pdf_path, output_dir, workers, {**settings, "mode": "pages"})
+            + extract_embedded_images(pdf_path, output_dir, settings)
+        )
+    workers = RENDER_WORKERS if workers is None else max(1, workers)
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+        if workers == 1 or page_count < PARALLEL_MIN_PAGES:
+            return [
+                _render_page(doc, page_number, pdf_path, output_dir, settings) for page_number in range(page_count)
+            ]
+
+    chunks = deque(
+        range(start, min(start + RENDER_CHUNK_PAGES, page_count))
+        for start in range(0, page_count, RENDER_CHUNK_PAGES)
+    )
+    workers = min(workers, len(chunks))
+    images_info = []
+    pending = deque()
+    # Spawned, not forked: uploads run in the server process, next to the compactor and pool
+    # threads, and a fork taken while one of them holds a lock would deadlock the worker
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        while chunks or pending:
+            while chunks and len(pending) < workers * RENDER_IN_FLIGHT:
+                pending.append(pool.submit(_render_pages, pdf_path, output_dir, chunks.popleft(), settings))
+            # Collect the oldest run first so pages come back in order
+            images_info.extend(pending.popleft().result())
+    print(f"📄 Rendered {page_count} pages of {os.path.basename(pdf_path)} on {workers} workers")
+    return images_info
@@ -0,0 +1,207 @@
+"""
+Batched similarity kernel for the matcher
+Scores one query against a whole stack of stored descriptors with broadcast NumPy operations
+"""
+
+import numpy as np
+
+# Weights of the four metrics in the final score
+MSE_WEIGHT = 0.3
+SSIM_WEIGHT = 0.3
+HIST_WEIGHT = 0.2
+EDGE_WEIGHT = 0.2
+
+CHUNK_SIZE = 512  # Rows scored per step, bounds the float32 temporaries
+BOUND_SLACK = 1e-3  # Covers float32 rounding between the bounds and the full kernel
+
+
+def score_batch(query: dict, gray: np.ndarray, hist: np.ndarray, grad: np.ndarray) -> np.ndarray:
+    """Score a query against N stored descriptors, returning N similarities in [0, 1]
+
+    gray is (N, 64, 64) uint8, hist is (N, 32) and grad is (N, 2, 64, 64), as kept
+    by the feature store. All arithmetic is done in float32 so uint8 never wraps.
+    """
+    count = len(gray)
+    scores = np.zeros(count, dtype=np.float32)
+    if count == 0:
+        return scores
+
+    q = query["gray"].astype(np.float32).ravel()
+    pixels = q.size
+    q_mean = q.mean()
+    q_var = q.var()
+    q_centered = q - q_mean
+    q_hist = query["hist"].astype(np.float32)
+    q_grad = query["grad"].astype(np.float32)
+
+    for start in range(0, count, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, count)
+        s = gray[start:stop].reshape(stop - start, -1).astype(np.float32)
+
+        # 1. Mean Squared Error (MSE)
+        diff = s - q
+        mse = np.einsum('ij,ij->i', diff, diff) / pixels
+        mse_similarity = 1 - mse / (255 ** 2)
+
+        # 2. Structural Similarity Index (SSIM-like), global means and variances
+        s_mean = s.mean(axis=1)
+        s_var = s.var(axis=1)
+        cross_corr = (s @ q_centered) / pixels  # q_centered sums to zero, so s needs no centering
+        var_sum = s_var + q_var
+        ssim_similarity = np.clip((2 * cross_corr + 0.01) / (var_sum + 0.01), 0, 1)
+        # Two flat images are only similar if they are the same flat image
+        flat = var_sum == 0
+        if flat.any():
+            ssim_similarity[flat] = (s_mean[flat] == q_mean).astype(np.float32)
+
+        # 3. Histogram intersection
+        hist_similarity = np.minimum(hist[start:stop].astype(np.float32), q_hist).sum(axis=1)
+
+        # 4. Edge comparison of the stored gradients
+        grad_diff = np.abs(grad[start:stop].astype(np.float32) - q_grad).mean(axis=(2, 3)).sum(axis=1)
+        edge_similarity = np.maximum(0, 1 - grad_diff / 510)
+
+        scores[start:stop] = (
+            MSE_WEIGHT * mse_similarity +
+            SSIM_WEIGHT * ssim_similarity +
+            HIST_WEIGHT * hist_similarity +
+            EDGE_WEIGHT * edge_similarity
+        )
+
+    return np.clip(scores, 0, 1)
+
+
+def _stack(queries: list, name: str) -> np.ndarray:
+    return np.stack([query[name] for query in queries]).astype(np.float32)
+
+
+def score_matrix(queries: list, gray: np.ndarray, hist: np.ndarray, grad: np.ndarray,
+                 mask: np.ndarray = None) -> np.ndarray:
+    """Score Q queries against N stored descriptors at once, returning a (Q, N) matrix
+
+    The MSE and SSIM-like terms come out of matrix products over the whole block; the edge
+    term is an L1 distance, so it is only computed for the (query, row) pairs in mask.
+    """
+    q_count, count = len(queries), len(gray)
+    scores = np.zeros((q_count, count), dtype=np.float32)
+    if q_count == 0 or count == 0:
+        return scores
+    if mask is None:
+        mask = np.ones((q_count, count), dtype=bool)
+
+    q = _stack(queries, "gray").reshape(q_count, -1)
+    pixels = q.shape[1]
+    q_mean = q.mean(axis=1)
+    q_var = q.var(axis=1)
+    q_centered = q - q_mean[:, None]
+    q_norms = np.einsum('ij,ij->i', q, q)
+    q_hist = _stack(queries, "hist")
+    q_grad = _stack(queries, "grad")
+
+    for start in range(0, count, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, count)
+        s = gray[start:stop].reshape(stop - start, -1).astype(np.float32)
+        s_norms = np.einsum('ij,ij->i', s, s)
+
+        # 1. MSE from |q|^2 + |s|^2 - 2 q.s
+        mse = np.maximum(q_norms[:, None] + s_norms[None, :] - 2 * (q @ s.T), 0) / pixels
+        mse_similarity = 1 - mse / (255 ** 2)
+
+        # 2. SSIM-like term, global means and variances
+        s_mean = s.mean(axis=1)
+        s_var = s.var(axis=1)
+        cross_corr = (q_centered @ s.T) / pixels
+        var_sum = q_var[:, None] + s_var[None, :]
+        ssim_similarity = np.clip((2 * cross_corr + 0.01) / (var_sum + 0.01), 0, 1)
+        flat = var_sum == 0
+        if flat.any():
+            ssim_similarity[flat] = (q_mean[:, None] == s_mean[None, :])[flat].astype(np.float32)
+
+        # 3. Histogram intersection
+        hist_similarity = histogram_matrix(queries, hist[start:stop])
+
+        # 4. Edge comparison, only where the pair is still wanted
+        edge_similarity = np.zeros_like(mse_similarity)
+        chunk_mask = mask[:, start:stop]
+        rows_needed = np.flatnonzero(chunk_mask.any(axis=0))
+        s_grad = grad[start:stop][rows_needed].astype(np.float32)
+        for i in range(q_count):
+            wanted = chunk_mask[i, rows_needed]
+            if not wanted.any():
+                continue
+            grad_diff = np.abs(s_grad[wanted] - q_grad[i]).mean(axis=(2, 3)).sum(axis=1)
+            edge_similarity[i, rows_needed[wanted]] = np.maximum(0, 1 - grad_diff / 510)
+
+        scores[:, start:stop] = (
+            MSE_WEIGHT * mse_similarity +
+            SSIM_WEIGHT * ssim_similarity +
+            HIST_WEIGHT * hist_similarity +
+            EDGE_WEIGHT * edge_similarity
+        )
+
+    scores[~mask] = 0
+    return np.clip(scores, 0, 1)
+
+
+def histogram_matrix(queries: list, hist: np.ndarray) -> np.ndarray:
+    """Histogram intersection of Q queries with N rows, exactly as score_batch computes it"""
+    return np.minimum(hist.astype(np.float32)[None], _stack(queries, "hist")[:, None]).sum(axis=2)
+
+
+def histogram_similarity(query: dict, hist: np.ndarray) -> np.ndarray:
+    return histogram_matrix([query], hist)[0]
+
+
+def upper_bound_matrix(queries: list, stats: np.ndarray, thumb: np.ndarray, hist_similarity: np.ndarray) -> np.ndarray:
+    """(Q, N) upper bounds on the full score from the coarse descriptors
+
+    stats and thumb are the stored cascade descriptors (see image_features.coarse_descriptors);
+    the histogram term is exact, the other three are bounded:
+    - MSE is at least the thumbnail MSE (block means) and (mean diff)^2 + (std diff)^2
+    - the SSIM-like term is at most its value at the Cauchy-Schwarz covariance bound
+    - the mean absolute gradient difference is at least the difference of mean |gradient|
+    """
+    q_stats = _stack(queries, "stats")[:, None, :]
+    thumb_pixels = thumb.shape[-1] * thumb.shape[-2]
+    q_thumb = _stack(queries, f"thumb{thumb.shape[-1]}").reshape(len(queries), thumb_pixels)
+    s_thumb = thumb.reshape(len(thumb), thumb_pixels).astype(np.float32)
+    stats = stats.astype(np.float32)[None]
+
+    thumb_mse = np.maximum(
+        np.einsum('ij,ij->i', q_thumb, q_thumb)[:, None]
+        + np.einsum('ij,ij->i', s_thumb, s_thumb)[None, :]
+        - 2 * (q_thumb @ s_thumb.T),
+        0
+    ) / q_thumb.shape[1]
+    s_std = np.sqrt(stats[..., 1])
+    q_std = np.sqrt(q_stats[..., 1])
+    stats_mse = (stats[..., 0] - q_stats[..., 0]) ** 2 + (s_std - q_std) ** 2
+    mse_bound = 1 - np.maximum(thumb_mse, stats_mse) / (255 ** 2)
+
+    ssim_bound = np.clip((2 * s_std * q_std + 0.01) / (stats[..., 1] + q_stats[..., 1] + 0.01), 0, 1)
+
+    grad_diff = np.abs(stats[..., 2:] - q_stats[..., 2:]).sum(axis=2)
+    edge_bound = np.maximum(0, 1 - grad_diff / 510)
+
+    return (
+        MSE_WEIGHT * mse_bound +
+        SSIM_WEIGHT * ssim_bound +
+        HIST_WEIGHT * hist_similarity +
+        EDGE_WEIGHT * edge_bound +
+        BOUND_SLACK
+    )
+
+
+def upper_bounds(query: dict, stats: np.ndarray, thumb: np.ndarray, hist_similarity: np.ndarray) -> np.ndarray:
+    """Upper bound on score_batch for N rows, see upper_bound_matrix"""
+    return upper_bound_matrix([query], stats, thumb, hist_similarity[None])[0]
+
+
+def compare_features(features1: dict, features2: dict) -> float:
+    """Calculate similarity between two sets of precomputed image descriptors"""
+    return float(score_batch(
+        features1,
+        features2["gray"][None],
+        features2["hist"][None],
+        features2["grad"][None]
+    )[0])
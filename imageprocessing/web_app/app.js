@@ -5,6 +5,11 @@ const API_BASE_URL = 'http://localhost:8000';
 let cameraStream = null;
 let capturedImage = null;
 let uploadedImage = null;
+let liveScanSocket = null;
+
+// Live scan settings: frames are downscaled before they are sent
+const LIVE_SCAN_MAX_SIDE = 320;
+const LIVE_SCAN_INTERVAL_MS = 200;
 
 // Check camera availability on page load
 document.addEventListener('DOMContentLoaded', function() {
@@ -130,6 +135,7 @@ function capturePhoto() {
 }
 
 function stopCamera() {
+    stopLiveScan();
     if (cameraStream) {
         cameraStream.getTracks().forEach(track => track.stop());
         cameraStream = null;
@@ -144,6 +150,79 @@ function stopCamera() {
     }
 }
 
+// Live scan: stream small frames over a WebSocket until the server reports a stable match
+function startLiveScan() {
+    if (!cameraStream) {
+        showCameraError('Camera not started');
+        return;
+    }
+    if (liveScanSocket) {
+        return;
+    }
+
+    const protocol = window.location.protocol === 'https:' ? 'wss' : 'ws';
+    const socket = new WebSocket(`${protocol}://${window.location.host}/ws/live-scan`);
+    socket.binaryType = 'arraybuffer';
+    liveScanSocket = socket;
+
+    socket.onopen = function() {
+        showStatus('Live scan running, point the camera at a print...', 'loading');
+        sendLiveFrame();
+    };
+
+    socket.onmessage = function(event) {
+        const message = JSON.parse(event.data);
+        if (message.type === 'match') {
+            console.log('Live scan match:', message);
+            displayResults(message);
+        } else if (message.type === 'error') {
+            console.error('Live scan error:', message.message);
+        } else if (message.rejected) {
+            showStatus(message.message, 'loading');
+        }
+        // One frame in flight at a time: the reply paces the next frame
+        setTimeout(sendLiveFrame, LIVE_SCAN_INTERVAL_MS);
+    };
+
+    socket.onerror = function(error) {
+        console.error('Live scan socket error:', error);
+        showStatus('Live scan connection failed', 'error');
+    };
+
+    socket.onclose = function() {
+        if (liveScanSocket === socket) {
+            liveScanSocket = null;
+        }
+    };
+}
+
+function sendLiveFrame() {
+    if (!liveScanSocket || liveScanSocket.readyState !== WebSocket.OPEN || !cameraStream) {
+        return;
+    }
+
+    const video = document.getElementById('video');
+    const scale = Math.min(1, LIVE_SCAN_MAX_SIDE / Math.max(video.videoWidth, video.videoHeight));
+    const frameCanvas = document.createElement('canvas');
+    frameCanvas.width = Math.round(video.videoWidth * scale);
+    frameCanvas.height = Math.round(video.videoHeight * scale);
+    frameCanvas.getContext('2d').drawImage(video, 0, 0, frameCanvas.width, frameCanvas.height);
+
+    frameCanvas.toBlob(async function(blob) {
+        if (blob && liveScanSocket && liveScanSocket.readyState === WebSocket.OPEN) {
+            liveScanSocket.send(await blob.arrayBuffer());
+        }
+    }, 'image/jpeg', 0.7);
+}
+
+function stopLiveScan() {
+    if (liveScanSocket) {
+        liveScanSocket.close();
+        liveScanSocket = null;
+        console.log('Live scan stopped');
+    }
+}
+
 function checkCameraAvailability() {
     if (!navigator.mediaDevices || !navigator.mediaDevices.getUserMedia) {
         showCameraError('Camera not supported in this browser');
@@ -244,6 +323,9 @@ async function matchImage(imageBlob, source = 'upload') {
             
             if (result.match_found) {
             displayResults(result);
+            } else if (result.rejected) {
+                // The server judged the photo unusable (dark, washed out, blank or blurry)
+                showStatus(result.message, 'error');
             } else {
                 displayNoResults(result.message);
             }
@@ -414,7 +496,7 @@ function displayDatabaseImages(images) {
     images.forEach(image => {
         imagesHTML += `
             <div class="result-item" style="margin: 0;">
-                <img src="/images/${image.image_path.split('/').pop()}" 
+                <img src="/images/${(image.thumbnail_path || image.image_path).split('/').pop()}" 
                      alt="${image.business_name}" 
                      style="width: 100%; height: 120px; object-fit: cover; border-radius: 8px; margin-bottom: 10px;">
                 <h4 style="font-size: 1rem; margin-bottom: 5px;">${image.business_name || 'Unknown'}</h4>
@@ -0,0 +1,41 @@
+import os
+import sys
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Add the imageprocessing directory to the path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imageprocessing'))
+
+from utils.image_features import check_frame_quality, FrameQualityError
+
+def sparse_page():
+    """A mostly white catalog page with a few lines of small print"""
+    page = Image.new("RGB", (1240, 1754), "white")
+    draw = ImageDraw.Draw(page)
+    for i in range(3):
+        draw.text((150, 180 + 30 * i), "Small print on a mostly white catalog page", fill="black")
+    return page
+
+def rejection(img):
+    try:
+        check_frame_quality(img)
+        return None
+    except FrameQualityError as e:
+        return e.reason
+
+def test_frame_quality():
+    """Sparse white pages are scannable; washed-out and dark frames are not"""
+    page = sparse_page()
+    assert rejection(page) is None, "a sparse white page must not be rejected"
+
+    rng = np.random.default_rng(0)
+    pixels = np.asarray(page, dtype=np.float32)
+    washed_out = np.clip(pixels * 0.1 + 230 + rng.normal(0, 2, pixels.shape), 0, 255).astype(np.uint8)
+    assert rejection(Image.fromarray(washed_out)) == "overexposed"
+
+    dark = np.clip(pixels * 0.1 + rng.normal(0, 2, pixels.shape), 0, 255).astype(np.uint8)
+    assert rejection(Image.fromarray(dark)) == "too_dark"
+    print("✅ Frame quality check passed")
+
+if __name__ == "__main__":
+    test_frame_quality()